@@ -0,0 +1,252 @@
+"""
+Benchmarks for CustomsBot, run against the in-process Discord stand-in
+in fake_discord.py, so no token or connection is needed.
+
+    python bench.py                      # run and print the results
+    python bench.py --save base.json     # ...and save them
+    python bench.py --compare base.json  # ...and flag regressions
+
+Measures the REST calls and latency of a squad vote from command to
+result, role grant throughput while the role message is flooded with
+reactions (plus unrelated gateway traffic), and how far the event loop
+lags behind while all that is going on.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Logs and the active vote database go somewhere disposable, so this has
+# to be set before customsbot is imported.
+os.environ.setdefault("CUSTOMSBOT_LOG_FOLDER", tempfile.mkdtemp())
+
+import customsbot
+from fake_discord import FakeDiscord, FakeTwitch, build_server
+
+# Metrics ending in one of these are better when higher; everything else
+# (latencies, calls, lag) is better when lower.
+higher_is_better = ("_per_sec",)
+
+class LagMonitor:
+    """Sample how late the event loop wakes up from a short sleep."""
+
+    def __init__(self, loop, interval=0.01):
+        self.loop = loop
+        self.interval = interval
+        self.samples = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            expected = self.loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0, self.loop.time() - expected))
+
+    def start(self):
+        self.task = self.loop.create_task(self.run())
+
+    def stats(self):
+        samples = sorted(self.samples) or [0]
+        return {"loop_lag_max": samples[-1],
+                "loop_lag_p99": samples[int(len(samples) * 0.99)
+                                        if len(samples) > 1 else 0]}
+
+async def wait_until(predicate, timeout, interval=0.01):
+    """Poll predicate() until it's true. Returns the time it became true."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("gave up waiting after {}s".format(timeout))
+        await asyncio.sleep(interval)
+    return time.monotonic()
+
+def channel_named(server, name):
+    return next(i for i in server.channels if i.name == name)
+
+async def bench_vote(client, server, duration, voters):
+    """Run $squadvote end to end, with voters reacting at random."""
+    definition = customsbot.vote_definitions["squadvote"]
+    original_duration = definition.get("duration")
+    definition["duration"] = duration
+    try:
+        return await time_vote(client, server, definition, duration, voters)
+    finally:
+        if original_duration is None:
+            del definition["duration"]
+        else:
+            definition["duration"] = original_duration
+
+async def time_vote(client, server, definition, duration, voters):
+    """bench_vote, once the vote's duration has been set."""
+    options = [i for i in definition["options"] if i["default"]]
+    hosters = channel_named(server, "custom-hosters")
+    customs = channel_named(server, "custom-games")
+
+    completed = client.loop.create_future()
+
+    async def on_command_completion(command, ctx):
+        if not completed.done():
+            completed.set_result(time.monotonic())
+
+    async def on_command_error(error, ctx):
+        if not completed.done():
+            completed.set_exception(error)
+
+    client.add_listener(on_command_completion)
+    client.add_listener(on_command_error)
+
+    def vote_message():
+        return next((i for i in customs.history
+                     if i.content.startswith(definition["prompt"])), None)
+
+    start = time.monotonic()
+    limited = sum(client.rate_limited.values())
+    client.say(hosters, server.members[0], "$squadvote")
+
+    posted = await wait_until(lambda: vote_message() is not None, 10)
+    message = vote_message()
+    seeded = await wait_until(
+        lambda: sum(i.me for i in message.reactions) == len(options), 30)
+
+    for member in server.members[1:voters + 1]:
+        client.react(message, random.choice(options)["emoji"], member)
+        await asyncio.sleep(duration / 2 / voters)
+
+    result = await wait_until(
+        lambda: message.content.startswith("Squad size vote over"),
+        duration + 30)
+    finished = await asyncio.wait_for(completed, 30)
+
+    client.remove_listener(on_command_completion)
+    client.remove_listener(on_command_error)
+
+    calls = client.call_counts(since=start)
+    results = {"vote_rest_calls": sum(calls.values()),
+               "vote_429s": sum(client.rate_limited.values()) - limited,
+               "vote_post_latency": posted - start,
+               "vote_seed_latency": seeded - posted,
+               "vote_result_latency": result - (posted + duration),
+               "vote_total_latency": finished - start - duration}
+    results.update(("vote_calls_" + method, count)
+                   for method, count in calls.items())
+    return results
+
+async def bench_role_flood(client, server, server_config, members, noise):
+    """Have members react to the role message at once, and time the grants."""
+    role_message = next(i for i in channel_named(server, "custom-games").history
+                        if i.id == server_config["reactionMessageID"])
+    custom_role = next(i for i in server.roles
+                       if i.id == server_config["customRoleID"])
+    flood = [i for i in server.members[:members] if custom_role not in i.roles]
+
+    start = time.monotonic()
+    limited = client.rate_limited["add_roles"]
+    for member in flood:
+        client.react(role_message, "\U0001F44D", member)
+        client.noise(server, noise)
+        await asyncio.sleep(0)
+
+    finished = await wait_until(
+        lambda: all(custom_role in i.roles for i in flood), 60 + len(flood))
+
+    state = customsbot.server_states[server.id]
+    return {"role_grants_per_sec": len(flood) / (finished - start),
+            "role_grant_429s": client.rate_limited["add_roles"] - limited,
+            "role_grant_max_latency": state.role_queue.stats()["max_latency"]}
+
+async def run_benchmarks(client, server, server_config, args):
+    monitor = LagMonitor(client.loop)
+    monitor.start()
+
+    client.dispatch("ready")
+    await asyncio.sleep(0.5)
+
+    results = await bench_vote(client, server, args.duration, args.voters)
+    results.update(await bench_role_flood(client, server, server_config,
+                                          args.members, args.noise))
+    results.update(monitor.stats())
+
+    # Stop everything the bot started, so the loop can close cleanly.
+    for task in asyncio.Task.all_tasks(client.loop):
+        if task is not asyncio.Task.current_task(client.loop):
+            task.cancel()
+    return results
+
+def build(args):
+    client = FakeDiscord(latency=args.latency, jitter=args.latency / 2)
+    server, server_config = build_server(client, num_members=args.members + 1)
+
+    config = dict(server_config, botID=client.user.id, botToken="",
+                  twitchClientID="")
+    config_path = os.path.join(os.environ["CUSTOMSBOT_LOG_FOLDER"],
+                               "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+
+    customsbot.create_bot(client=client, twitch=FakeTwitch(),
+                          config=customsbot.JSONFile(config_path,
+                                                     customsbot.validate_config))
+    return client, server, server_config
+
+def compare(results, baseline, threshold):
+    """Lines describing every metric more than threshold worse than baseline."""
+    regressions = []
+    for name, value in sorted(results.items()):
+        old = baseline.get(name)
+        if not old:
+            continue
+        change = (value - old) / old
+        if name.endswith(higher_is_better):
+            change = -change
+        if change > threshold:
+            regressions.append("{}: {:.4g} -> {:.4g} ({:+.0%})".format(
+                name, old, value, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration", type=float, default=15,
+                        help="squad vote length in seconds")
+    parser.add_argument("--voters", type=int, default=50)
+    parser.add_argument("--members", type=int, default=40,
+                        help="members reacting to the role message")
+    parser.add_argument("--noise", type=int, default=20,
+                        help="unrelated gateway frames per reaction")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds each fake REST call takes")
+    parser.add_argument("--save", metavar="FILE")
+    parser.add_argument("--compare", metavar="FILE")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fraction worse than the baseline to flag")
+    args = parser.parse_args()
+    args.members = max(args.members, args.voters)
+    random.seed(0)
+
+    client, server, server_config = build(args)
+    results = client.loop.run_until_complete(
+        run_benchmarks(client, server, server_config, args))
+    client.loop.run_until_complete(client.http.close())
+
+    for name, value in sorted(results.items()):
+        print("{:<28}{:.4g}".format(name, value))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("\nRegressions:")
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("\nNo regressions.")
+
+if __name__ == "__main__":
+    main()
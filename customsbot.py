@@ -3,119 +3,615 @@ from discord.ext import commands
 import asyncio
 import datetime
 import random
+import math
+import time
 import os
 import json
-from collections import OrderedDict
+import re
+import heapq
+import itertools
+import queue
+import sqlite3
+import concurrent.futures
+import atexit
+import threading
+import functools
+import logging
+import weakref
+from collections import OrderedDict, deque
 from twitch import TwitchClient
 
 file_path = os.path.dirname(__file__)
 
-config_path = os.path.join(file_path, 'config.json')
-config_data = json.load(open(config_path))
+class JSONFile:
+    """
+    A JSON file which is read the first time it's needed, and read again
+    while the bot runs whenever watch() sees it change on disk or a
+    hoster uses $reload.
+
+    A new version only replaces the current one once it has parsed and
+    passed validate(), so a mistake in the file leaves the bot running
+    on the last good version. Anything built from the file (rendered(),
+    such as the help embed) is cached with the version it came from,
+    and the two are swapped together.
+    """
 
-discord_client = commands.Bot(command_prefix='$')
-twitch_client = TwitchClient(client_id= config_data["twitchClientID"])
+    def __init__(self, path, validate=None, on_reload=None, interval=5):
+        self.path = path
+        self.validate = validate
+        self.on_reload = on_reload
+        self.interval = interval
+        self.current = None  # (mtime, data, {rendered name: result})
+        self.failed_mtime = None
+        self.task = None
+
+    @property
+    def data(self):
+        if self.current is None:
+            error = self.reload()
+            if error:
+                raise ValueError(error)
+        return self.current[1]
+
+    def reload(self):
+        """
+        Read the file again. Returns an error message if it couldn't be
+        used, or None if the new version is now live.
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as error:
+            return str(error)
 
-#Checks if the logs folder exists, creates it if not.
-log_folder = os.path.join(file_path,"logs")
+        try:
+            with open(self.path) as file:
+                data = json.load(file, object_pairs_hook=OrderedDict)
+            if self.validate is not None:
+                self.validate(data)
+        except (OSError, ValueError) as error:
+            self.failed_mtime = mtime
+            return "{}: {}".format(os.path.basename(self.path), error)
+
+        first_load = self.current is None
+        self.current = (mtime, data, {})
+        if self.on_reload is not None and not first_load:
+            self.on_reload(data)
+        return None
+
+    def changed(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        loaded_mtime = self.current[0] if self.current else None
+        return mtime not in (loaded_mtime, self.failed_mtime)
+
+    def rendered(self, name, render):
+        """render(data), worked out once per version of the file."""
+        data = self.data
+        cache = self.current[2]
+        if name not in cache:
+            cache[name] = render(data)
+        return cache[name]
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = discord_client.loop.create_task(self.watch())
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.changed():
+                error = self.reload()
+                if error:
+                    print("Keeping the previous version of", error)
+
+server_keys = ("serverID", "customRoleID", "channels", "emojis",
+               "regionEmojis", "reactionMessageID")
+
+def load_server_configs(config):
+    """
+    The settings for each server the bot runs customs on. Servers are
+    listed under "servers" in config.json, each with its own copy of
+    server_keys; a config without "servers" sets up a single server at
+    the top level, as before.
+    """
+    server_configs = config.get("servers")
+    if server_configs is None:
+        server_configs = [{key: config[key] for key in server_keys
+                           if key in config}]
+    return server_configs
+
+def validate_config(config):
+    for key in ("botID", "botToken", "twitchClientID"):
+        if key not in config:
+            raise ValueError("missing " + key)
+
+    for server_config in load_server_configs(config):
+        for key in ("serverID", "customRoleID", "channels"):
+            if key not in server_config:
+                raise ValueError("a server is missing " + key)
+        for name in ("hoster", "customgames", "sssc"):
+            if name not in server_config["channels"]:
+                raise ValueError("server {} is missing the {} channel".format(
+                    server_config["serverID"], name))
+
+# Every response the bot can look up, by section of bot_text.json.
+required_text = {
+    "pmResponses": ("primary", "roleSuccess", "rolePresent", "schedule",
+                    "twitch", "forms", "removeSuccess", "removeFailure",
+                    "slowDown"),
+    "chatResponses": ("schedule", "twitch", "streamLive", "streamOffline")}
+
+def validate_text(text):
+    for section, keys in required_text.items():
+        missing = [i for i in keys if i not in text.get(section, {})]
+        if missing:
+            raise ValueError("{} is missing {}".format(section,
+                                                       ", ".join(missing)))
+
+    if not isinstance(text.get("helpText"), list):
+        raise ValueError("helpText should be a list")
+
+config_path = os.path.join(file_path, 'config.json')
+# The token, Twitch client and shard settings are only read at startup;
+# server settings are applied again whenever the file is reloaded.
+config_file = JSONFile(config_path, validate_config,
+                       on_reload=lambda config: apply_server_configs(config))
+
+# Set by create_bot(). Everything talks to Discord and Twitch through
+# these, so a stand-in client can be swapped in for both.
+discord_client = None
+twitch_client = None
+
+# Events and commands are collected as they're defined, and attached to
+# the client in create_bot().
+bot_events = []
+bot_commands = []
+
+def bot_event(coro):
+    bot_events.append(coro)
+    return coro
+
+def bot_command(**attrs):
+    def decorator(func):
+        timed_func = perf.timed(attrs.get("name", func.__name__), func)
+        command = commands.command(**attrs)(timed_func)
+        bot_commands.append(command)
+        return command
+    return decorator
+
+#Checks if the logs folder exists, creates it if not. Benchmarks point
+# CUSTOMSBOT_LOG_FOLDER elsewhere so their runs stay out of the real logs.
+log_folder = os.environ.get("CUSTOMSBOT_LOG_FOLDER",
+                            os.path.join(file_path,"logs"))
 folder_exists = os.path.isdir(log_folder)
 if not folder_exists:
         os.mkdir(log_folder)
 
-# Stop inbuilt $help overriding ours.
-discord_client.remove_command('help')
-
 bot_text_path = os.path.join(file_path,'bot_text.json')
-text_data = json.load(open(bot_text_path))
+bot_text = JSONFile(bot_text_path, validate_text)
+
+vote_definitions_path = os.path.join(file_path, 'votes.json')
+fullvote_path = os.path.join(file_path, 'fullvote.json')
 
 def hoster_only():
     """
     Trust commands from #custom-hosters only. Everyone in that channel
     is a moderator or host, so anyone sending commands here is legitimate.
+    Each server has its own hoster channel.
     """
     def predicate(ctx):
-        customs_channel = get_custom_games()
-        hoster_channel = discord_client.get_channel(
-            config_data["channels"]["hoster"])
-
-        return ctx.message.channel == hoster_channel
+        return in_hoster_channel(ctx.message)
+    # Lets on_message turn these away before the commands extension
+    # gets involved.
+    predicate.hoster_only = True
     return commands.check(predicate)
 
-async def twitch_check(previous_presence=None):
+def in_hoster_channel(message):
+    state = server_state(message.server)
+    return (state is not None
+            and message.channel == state.channels.get("hoster"))
+
+class TwitchStatus:
     """
-    Every 5 minutes (300 sec), check the pubgreddit Twitch channel.
-    If we get any data back, the stream is live; None means it isn't.
+    Every 5 minutes (300 sec), check the pubgreddit Twitch channel in the
+    background. If we get any data back, the stream is live; None means
+    it isn't.
+
+    The Twitch client is blocking, so requests run in an executor with a
+    timeout, and failures are retried with jittered exponential backoff.
+    The last result is cached for anything else that wants to know if
+    we're live; it's treated as unknown once it's older than ttl seconds.
     """
-    while True:
-        pubgreddit_stream = twitch_client.streams.get_stream_by_user(
-            '153910806')
 
-        if pubgreddit_stream is not None:
-            game_presence = discord.Game(name="Custom games",
-                                         url="https://twitch.tv/pubgreddit",
-                                         type=1)
-        else:
-            game_presence = discord.Game(name="See #custom-games-info for info")
+    def __init__(self, user_id='153910806', interval=300, timeout=10,
+                 ttl=900):
+        self.user_id = user_id
+        self.interval = interval
+        self.timeout = timeout
+        self.ttl = ttl
+        self.live = None
+        self.checked_at = None
+        self.failures = 0
+        self.poller = None
+
+    def start(self):
+        """Start polling, unless a poller is already running."""
+        if self.poller is None or self.poller.done():
+            self.poller = discord_client.loop.create_task(self.run())
+
+    def is_live(self):
+        """True or False from the cache, or None if it's stale or unset."""
+        if self.checked_at is None:
+            return None
+        if time.monotonic() - self.checked_at > self.ttl:
+            return None
+        return self.live
+
+    async def fetch(self):
+        stream_request = discord_client.loop.run_in_executor(
+            None, twitch_client.streams.get_stream_by_user, self.user_id)
+        return await asyncio.wait_for(stream_request, self.timeout)
+
+    async def run(self):
+        previous_presence = None
+
+        while True:
+            try:
+                pubgreddit_stream = await self.fetch()
+            except Exception as error:
+                self.failures += 1
+                retry_delay = min(15 * 2 ** self.failures, self.interval)
+                print("Twitch check failed:", repr(error))
+                await asyncio.sleep(retry_delay * random.uniform(0.5, 1.5))
+                continue
+
+            self.failures = 0
+            self.live = pubgreddit_stream is not None
+            self.checked_at = time.monotonic()
+
+            if self.live:
+                game_presence = discord.Game(name="Custom games",
+                                             url="https://twitch.tv/pubgreddit",
+                                             type=1)
+            else:
+                game_presence = discord.Game(name="See #custom-games-info for info")
 
-        #Only update the presence if it changed since last time
-        if previous_presence != game_presence:
-            await discord_client.change_presence(game=game_presence)
+            #Only update the presence if it changed since last time
+            if previous_presence != game_presence:
+                await discord_client.change_presence(game=game_presence)
 
-        previous_presence = game_presence
+            previous_presence = game_presence
 
-        await asyncio.sleep(300)
+            await asyncio.sleep(self.interval)
 
-def get_custom_games():
-    """Returns #custom-games channel object"""
-    customs_channel = discord_client.get_channel(
-        config_data["channels"]["customgames"])
+twitch_status = TwitchStatus()
 
-    return customs_channel
+def twitch_text(twitch_info):
+    """Twitch info text, followed by whether we're live if we know."""
+    return stream_status_text(twitch_info, twitch_status.is_live(),
+                              bot_text.data)
 
-def log_command(message_object, text, error=False):
-    """Whenever a command is sent, log it to today's log file"""
-    log_path = os.path.join(file_path, 'logs')
-    file_name = datetime.datetime.now().strftime("%Y%m%d") + ".txt"
+def stream_status_text(twitch_info, live, text):
+    """twitch_info for a given stream status, using text from bot_text.json."""
+    if live is None:
+        return twitch_info
+    elif live:
+        status_text = text["chatResponses"]["streamLive"]
+    else:
+        status_text = text["chatResponses"]["streamOffline"]
+    return twitch_info + "\n\n" + status_text
 
-    logfile = os.path.join(log_path, file_name)
+def get_custom_games(state):
+    """Returns a server's #custom-games channel object"""
+    return state.channels.get("customgames")
 
+class LogWriter:
+    """
+    Writes command log lines from a background thread so commands never
+    wait on disk.
+
+    Lines are queued with the date they were logged and written to that
+    day's file, which is kept open until the date changes. Each line can
+    also carry a structured record, which is added to the commands
+    table of the log database, and vote results carry their full tally
+    for the vote_results and vote_counts tables. All are flushed every batch_size lines
+    or flush_interval seconds, whichever comes first, and close() writes
+    out anything still queued.
+
+    A line which can't be written (the database locked by $stats for
+    longer than SQLite waits, a full disk...) is reported and skipped,
+    so one bad write never stops the thread. If the thread has stopped
+    anyway, the next write() starts a new one.
+    """
+
+    def __init__(self, folder, batch_size=50, flush_interval=2):
+        self.folder = folder
+        self.db = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = None
+        self.file = None
+        self.file_date = None
+
+    def write(self, line, record=None, date=None, vote_records=None):
+        if date is None:
+            date = datetime.date.today()
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.queue.put((date, line, record, vote_records))
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        # SQLite connections can only be used from the thread they were
+        # made in, so this one is opened here rather than in __init__.
+        self.db = open_log_db()
+        unflushed = 0
+        last_flush = time.monotonic()
+
+        while True:
+            timeout = max(self.flush_interval
+                          - (time.monotonic() - last_flush), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                break
+            if item:
+                try:
+                    self.write_line(*item)
+                except (OSError, sqlite3.Error) as error:
+                    print("Couldn't write log line:", repr(error))
+                unflushed += 1
+
+            flush_due = time.monotonic() - last_flush >= self.flush_interval
+            if unflushed >= self.batch_size or (unflushed and flush_due):
+                self.flush()
+                unflushed = 0
+            if flush_due:
+                last_flush = time.monotonic()
+
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.file_date = None
+        self.db.close()
+
+    def flush(self):
+        # Anything not committed is left for the next flush to try again.
+        try:
+            if self.file is not None:
+                self.file.flush()
+            self.db.commit()
+        except (OSError, sqlite3.Error) as error:
+            print("Couldn't flush the logs:", repr(error))
+
+    def write_line(self, date, line, record, vote_records):
+        if date != self.file_date or self.file is None:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            file_name = date.strftime("%Y%m%d") + ".txt"
+            self.file = open(os.path.join(self.folder, file_name), "a")
+            self.file_date = date
+
+        self.file.write(line)
+
+        if record is not None:
+            self.db.execute("INSERT INTO commands VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            record)
+
+        if vote_records is not None:
+            result, counts = vote_records
+            self.db.execute("INSERT OR REPLACE INTO vote_results"
+                            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", result)
+            self.db.executemany("INSERT INTO vote_counts VALUES (?, ?, ?)",
+                                counts)
+
+log_db_path = os.path.join(log_folder, "commands.sqlite")
+log_writer = LogWriter(log_folder)
+atexit.register(log_writer.close)
+
+def open_log_db():
+    """
+    Connect to the structured command log, creating it if needed.
+
+    Every logged command is a row in the commands table. time is an ISO
+    UTC timestamp, command is the first part of the log text in lower
+    case (e.g. 'role', 'squad vote') and detail is the rest. result is
+    set for vote results.
+
+    Each finished vote (and each setting of a full vote) is also a row
+    in vote_results, keyed on its message ID, with how many votes every
+    option got in vote_counts. vote is the vote command's name, or the
+    setting's name for full votes, and seed is what its tie-break was
+    seeded with.
+    """
+    db = sqlite3.connect(log_db_path)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS commands (
+            time TEXT NOT NULL,
+            command TEXT NOT NULL,
+            detail TEXT NOT NULL,
+            dm INTEGER NOT NULL,
+            user_id TEXT,
+            user_name TEXT,
+            error INTEGER NOT NULL,
+            result TEXT
+        );
+        CREATE INDEX IF NOT EXISTS commands_time ON commands (time);
+        CREATE INDEX IF NOT EXISTS commands_command
+            ON commands (command, time);
+        CREATE INDEX IF NOT EXISTS commands_dm ON commands (dm, time);
+        CREATE INDEX IF NOT EXISTS commands_user ON commands (user_id, time);
+
+        CREATE TABLE IF NOT EXISTS vote_results (
+            message_id TEXT PRIMARY KEY,
+            vote TEXT NOT NULL,
+            server_id TEXT,
+            winner TEXT NOT NULL,
+            votes INTEGER NOT NULL,
+            turnout INTEGER NOT NULL,
+            tied INTEGER NOT NULL,
+            seed TEXT,
+            time TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS vote_results_vote
+            ON vote_results (vote, server_id, time);
+        CREATE TABLE IF NOT EXISTS vote_counts (
+            message_id TEXT NOT NULL,
+            option TEXT NOT NULL,
+            votes INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS vote_counts_message
+            ON vote_counts (message_id);
+    """)
+    return db
+
+def log_event(text, user, timestamp, dm=False, error=False, result=None,
+              tally=None):
+    """
+    Log an action to today's log file and the command log database.
+    text is split on | into the command and its details, ignoring the
+    DM marker since dm is stored separately. A vote result's VoteTally
+    is saved with it as tally.
+    """
     if error:
         status = "| Incorrect command"
     else:
         status = ""
 
-    with open(logfile, "a") as file:
-        log_string = "{} | {} | {}#{} {}\n"
-        log_string = log_string.format(str(message_object.timestamp),
-                                       text,
-                                       message_object.author.name,
-                                       message_object.author.discriminator,
-                                       status)
-        file.write(log_string)
+    log_string = "{} | {} | {}#{} {}\n"
+    log_string = log_string.format(str(timestamp),
+                                   text,
+                                   user.name,
+                                   user.discriminator,
+                                   status)
 
-def most_reactions(message, num_only=False):
-    """
-    Given a message, determine which reaction emoji received the
-    most votes. Breaks ties with a random choice.
-    """
-    reaction_emojis, reaction_count = [], []
-    if num_only:
-        message.reactions = [i for i in message.reactions if type(i.emoji) == str]
+    text_parts = [i.strip() for i in text.split("|")]
+    detail = " | ".join(i for i in text_parts[1:] if i != "DM")
+    record = (timestamp.isoformat(), text_parts[0].lower(), detail, int(dm),
+              user.id, user.name, int(error), result)
 
-    for message_reaction in message.reactions:
-        reaction_emojis.append(message_reaction.emoji)
-        reaction_count.append(message_reaction.count)
+    # Votes with no message or no options have nothing to save.
+    vote_records = None
+    if (tally is not None and tally.message_id is not None
+            and tally.winner is not None):
+        vote_result, vote_counts = tally.records()
+        vote_records = (vote_result + (timestamp.isoformat(),), vote_counts)
 
-    max_emoji = [reaction_emojis[i] for i,x in enumerate(reaction_count)
-                 if x == max(reaction_count)]
+    log_writer.write(log_string, record, vote_records=vote_records)
 
-    num_emojis = len(max_emoji)
+def log_command(message_object, text, error=False, result=None, tally=None):
+    """Whenever a command is sent, log it to today's log file"""
+    log_event(text, message_object.author, message_object.timestamp,
+              dm=message_object.server is None, error=error, result=result,
+              tally=tally)
 
-    if num_emojis == 1:
-        return max_emoji[0]
-    else:
-        i = random.randint(0,num_emojis-1)
-        return max_emoji[i]
+class ActiveStore:
+    """
+    Votes and timers which are still running, kept in SQLite so they
+    can be finished if the bot restarts part way through one.
+
+    Each row is keyed on the message being counted down, with the kind
+    of command it belongs to, its deadline as a Unix timestamp and
+    whatever else that command needs to finish (the server and channel,
+    the @here ping, ...) as JSON. Writes go through a single worker
+    thread, so they happen in order and commands never wait on disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.db = None
+        # Entries left over from the last run which haven't been resumed
+        # yet, loaded on the first resume(): message ID: row.
+        self.unresumed = None
+
+    def execute(self, sql, parameters=()):
+        # Only ever called from the worker thread.
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS active ("
+                            "message_id TEXT PRIMARY KEY, kind TEXT, "
+                            "deadline REAL, data TEXT)")
+        rows = self.db.execute(sql, parameters).fetchall()
+        self.db.commit()
+        return rows
+
+    def run(self, sql, parameters=()):
+        return discord_client.loop.run_in_executor(self.executor, self.execute,
+                                                   sql, parameters)
+
+    def add(self, kind, message, deadline, state, **data):
+        data["server"] = state.id
+        data["channel"] = message.channel.id
+        return self.run("INSERT OR REPLACE INTO active VALUES (?, ?, ?, ?)",
+                        (message.id, kind, deadline.timestamp(),
+                         json.dumps(data)))
+
+    def remove(self, message):
+        return self.run("DELETE FROM active WHERE message_id = ?",
+                        (message.id,))
+
+    async def resume(self):
+        """
+        Pick the votes and timers stored by the last run back up. Anything
+        whose deadline passed while we were down is finished straight
+        away. This runs on every on_ready and whenever a server becomes
+        available, so entries for a server which wasn't available the
+        first time are picked up once it is; each entry is only resumed
+        once. Entries for servers we never see (on another shard) are
+        left for whichever process can.
+        """
+        if self.unresumed is None:
+            self.unresumed = {}
+            rows = await self.run("SELECT message_id, kind, deadline, data"
+                                  " FROM active")
+            self.unresumed.update((row[0], row) for row in rows)
+
+        for message_id, kind, deadline, data in list(
+                self.unresumed.values()):
+            data = json.loads(data)
+            state = server_states.get(data["server"])
+            if state is None or state.server is None:
+                continue
+            del self.unresumed[message_id]
+            channel = state.server.get_channel(data["channel"])
+            deadline = datetime.datetime.fromtimestamp(deadline)
+            discord_client.loop.create_task(
+                self.resume_one(state, channel, message_id, kind, deadline,
+                                data))
+
+    async def resume_one(self, state, channel, message_id, kind, deadline,
+                         data):
+        try:
+            message = None
+            if kind not in resume_handlers or (
+                    kind == "vote" and data["vote"] not in vote_definitions):
+                print("Dropping", kind, message_id,
+                      "which can't be finished any more:", data)
+            elif channel is not None:
+                message = await fetch_message(channel, message_id)
+            if message is not None:
+                await resume_handlers[kind](state, message, deadline, data)
+        except discord.HTTPException as error:
+            print("Couldn't resume", kind, message_id, error)
+
+        await self.run("DELETE FROM active WHERE message_id = ?",
+                       (message_id,))
+
+active_store = ActiveStore(os.path.join(log_folder, "active.sqlite"))
 
 def get_countdown_string(timedelta_object):
     """Given a timedelta object, returns a mm:ss time string"""
@@ -123,57 +619,905 @@ def get_countdown_string(timedelta_object):
     countdown_timer_string = ":".join(countdown_timer_split[1:])
     return countdown_timer_string.split(".")[0]  # Without decimal
 
-def get_custom_role():
-    pubg_server = discord_client.get_server(config_data["serverID"])
-    custom_role_id = config_data["customRoleID"]
-    return discord.utils.get(pubg_server.roles, id=custom_role_id)
+def percentile(samples, fraction):
+    """The sample fraction of the way through samples, or None if empty."""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+class CommandTiming:
+    """Timestamps and REST call counts for one run of a command."""
+
+    def __init__(self, name, received):
+        self.name = name
+        self.received = received  # When on_message saw it, if it did.
+        self.started = time.monotonic()
+        self.first_response = None
+        self.rest_calls = 0
+        self.rate_limited = 0
+
+class PerfMonitor:
+    """
+    Where the bot's time goes, for when timers drift or votes close late.
+
+    Tracks how late the event loop wakes up, how long each command takes
+    to parse (from on_message to the handler), to first respond and to
+    complete, the REST calls and 429s each run makes, how far past their
+    deadline countdowns post their result, and the depth of the
+    background queues. The last sample_size samples of each are kept.
+
+    REST calls are tied to the command whose task queued them; work a
+    command hands off to another task is tied back to it with spawn().
+    Everything is shown by $perf, and written every export_interval
+    seconds to a Prometheus text file (metrics.prom in the log folder)
+    for node_exporter's textfile collector to pick up.
+    """
 
-def get_user_member(user):
-    pubg_server = discord_client.get_server(config_data["serverID"])
-    pubg_member = pubg_server.get_member(user.id)
-    return pubg_member
+    def __init__(self, path, lag_interval=0.5, export_interval=15,
+                 sample_size=200):
+        self.path = path
+        self.lag_interval = lag_interval
+        self.export_interval = export_interval
+        self.sample_size = sample_size
+        self.received = OrderedDict()  # message ID: time on_message saw it
+        self.timings = weakref.WeakKeyDictionary()  # task: CommandTiming
+        self.commands = {}
+        self.drift = {}
+        self.lag = deque(maxlen=sample_size)
+        self.max_lag = 0
+        self.rest_calls = 0
+        self.rate_limited = 0
+        self.monitor = None
+
+    def start(self):
+        """Start the lag monitor and exporter, unless they're running."""
+        if self.monitor is None or self.monitor.done():
+            self.monitor = discord_client.loop.create_task(self.run())
+
+    async def run(self):
+        loop = discord_client.loop
+        last_export = loop.time()
+
+        while True:
+            expected = loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            lag = max(loop.time() - expected, 0)
+            self.lag.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            if loop.time() - last_export >= self.export_interval:
+                last_export = loop.time()
+                try:
+                    await loop.run_in_executor(None, self.export,
+                                               self.render())
+                except OSError as error:
+                    print("Couldn't write metrics:", error)
+
+    def export(self, text):
+        # Written to one side then moved over, so a reader never sees
+        # half a file.
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(text)
+        os.replace(temp_path, self.path)
+
+    def message_received(self, message):
+        self.received[message.id] = time.monotonic()
+        # Anything that never became a command is forgotten eventually.
+        while len(self.received) > self.sample_size:
+            self.received.popitem(last=False)
+
+    def current(self):
+        """The CommandTiming of the command the current task is running."""
+        return self.timings.get(asyncio.Task.current_task())
+
+    def set_current(self, timing):
+        task = asyncio.Task.current_task()
+        if timing is None:
+            self.timings.pop(task, None)
+        else:
+            self.timings[task] = timing
+
+    def spawn(self, coro, timing=None):
+        """
+        Create a task whose REST calls count towards timing, or the
+        current command if none is given.
+        """
+        if timing is None:
+            timing = self.current()
+        task = discord_client.loop.create_task(coro)
+        if timing is not None:
+            self.timings[task] = timing
+        return task
+
+    def timed(self, name, func):
+        """Wrap a command handler so each run is timed."""
+        @functools.wraps(func)
+        async def timed_command(ctx, *args, **kwargs):
+            timing = CommandTiming(name,
+                                   self.received.pop(ctx.message.id, None))
+            self.set_current(timing)
+            try:
+                return await func(ctx, *args, **kwargs)
+            finally:
+                self.set_current(None)
+                self.command_finished(timing)
+        return timed_command
+
+    def command_finished(self, timing):
+        stats = self.commands.get(timing.name)
+        if stats is None:
+            stats = self.commands[timing.name] = {
+                "count": 0, "rest_calls": 0, "rate_limited": 0,
+                "parse": deque(maxlen=self.sample_size),
+                "first_response": deque(maxlen=self.sample_size),
+                "completion": deque(maxlen=self.sample_size)}
+
+        # Times are from when the message arrived, where we know it.
+        start = timing.received or timing.started
+        stats["count"] += 1
+        stats["rest_calls"] += timing.rest_calls
+        stats["rate_limited"] += timing.rate_limited
+        if timing.received is not None:
+            stats["parse"].append(timing.started - timing.received)
+        if timing.first_response is not None:
+            stats["first_response"].append(timing.first_response - start)
+        stats["completion"].append(time.monotonic() - start)
+
+    def rest_call(self, timing):
+        self.rest_calls += 1
+        if timing is not None:
+            timing.rest_calls += 1
+            if timing.first_response is None:
+                timing.first_response = time.monotonic()
+
+    def rate_limit(self):
+        """Count a 429, against the current command if there is one."""
+        self.rate_limited += 1
+        timing = self.current()
+        if timing is not None:
+            timing.rate_limited += 1
+
+    def countdown_finished(self, kind, deadline):
+        """Record how late a countdown's result went out."""
+        drift = (datetime.datetime.now() - deadline).total_seconds()
+        self.drift.setdefault(kind, deque(maxlen=self.sample_size)).append(
+            drift)
+
+    def queue_depths(self):
+        depths = OrderedDict()
+        depths["outbound"] = outbound.stats()["depth"]
+        depths["log writer"] = log_writer.queue.qsize()
+        depths["countdowns"] = len(countdown_scheduler.countdowns)
+        depths["DMs"] = dm_pipeline.stats()["depth"]
+        for state in server_states.values():
+            server_name = state.server.name if state.server else state.id
+            depths["roles " + server_name] = state.role_queue.stats()["depth"]
+        return depths
+
+    def render(self):
+        """Every metric in the Prometheus text format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP customsbot_{} {}".format(name, help_text))
+            lines.append("# TYPE customsbot_{} {}".format(name, kind))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_text = ",".join('{}="{}"'.format(
+                    key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+                if label_text:
+                    label_text = "{" + label_text + "}"
+                lines.append("customsbot_{}{} {}".format(name, label_text,
+                                                         value))
+
+        def quantiles(samples, **labels):
+            return [(dict(labels, quantile=str(q)), percentile(samples, q))
+                    for q in (0.5, 0.99)]
+
+        metric("event_loop_lag_seconds", "gauge",
+               "How late the event loop wakes up from a sleep.",
+               quantiles(self.lag) + [({"quantile": "1"}, self.max_lag)])
+
+        metric("commands_total", "counter", "Commands run.",
+               [({"command": name}, stats["count"])
+                for name, stats in self.commands.items()])
+        metric("command_seconds", "gauge",
+               "Time to parse, first respond to and complete a command.",
+               [sample for name, stats in self.commands.items()
+                for phase in ("parse", "first_response", "completion")
+                for sample in quantiles(stats[phase], command=name,
+                                        phase=phase)])
+        metric("command_rest_calls_total", "counter",
+               "REST calls made by a command.",
+               [({"command": name}, stats["rest_calls"])
+                for name, stats in self.commands.items()])
+        metric("command_rate_limited_total", "counter",
+               "429 responses to a command's REST calls.",
+               [({"command": name}, stats["rate_limited"])
+                for name, stats in self.commands.items()])
+
+        metric("rest_calls_total", "counter", "REST calls made.",
+               [({}, self.rest_calls)])
+        metric("rate_limited_total", "counter", "429 responses.",
+               [({}, self.rate_limited)])
+
+        metric("countdown_drift_seconds", "gauge",
+               "How long after its deadline a countdown posted its result.",
+               [sample for kind, drift in self.drift.items()
+                for sample in quantiles(drift, kind=kind)])
+
+        metric("queue_depth", "gauge", "Items waiting in background queues.",
+               [({"queue": name}, depth)
+                for name, depth in self.queue_depths().items()])
+
+        metric("outbound_wait_seconds", "gauge",
+               "Time REST requests waited in the outbound queue.",
+               [sample for priority, name in priority_names.items()
+                for sample in quantiles(outbound.wait_times[priority],
+                                        priority=name)])
+        metric("outbound_coalesced_total", "counter",
+               "Queued edits replaced by a newer edit to the same message.",
+               [({}, outbound.coalesced)])
+
+        role_states = list(server_states.values())
+        metric("role_changes_total", "counter",
+               "Role changes from reactions, applied or given up on.",
+               [({"server": state.id, "result": result},
+                 state.role_queue.stats()[result])
+                for state in role_states for result in ("applied", "failed")])
+        metric("role_change_seconds", "gauge",
+               "Time from a role reaction to the role change being made.",
+               [sample for state in role_states
+                for sample in quantiles(state.role_queue.latencies,
+                                        server=state.id)])
+
+        metric("command_messages_total", "counter",
+               "Messages starting with $: unknown, unauthorized, throttled "
+               "or dispatched to a command.",
+               [({"result": name}, count)
+                for name, count in dispatch_stats.items()])
+
+        dm_stats = dm_pipeline.stats()
+        metric("dm_messages_total", "counter",
+               "DMs received, and what happened to them.",
+               [({"result": name}, dm_stats[name])
+                for name in ("received", "coalesced", "rate_limited",
+                             "dropped", "handled", "failed")])
+        metric("dm_reply_seconds", "gauge",
+               "Time from a DM being queued to it being answered.",
+               quantiles(dm_pipeline.latencies))
+
+        metric("gateway_frames_total", "counter",
+               "Raw gateway frames seen, skipped and handled.",
+               [({"result": name}, count)
+                for name, count in gateway_stats.items()])
+
+        return "\n".join(lines) + "\n"
+
+perf = PerfMonitor(os.path.join(log_folder, "metrics.prom"))
+
+class RateLimitCounter(logging.Handler):
+    """
+    discord.py retries 429s by itself, only logging that it did, so
+    they're counted from its log.
+    """
 
-def has_custom_role(user):
+    def emit(self, record):
+        if record.getMessage().startswith("We are being rate limited"):
+            perf.rate_limit()
+
+discord_http_log = logging.getLogger("discord.http")
+discord_http_log.setLevel(logging.INFO)
+discord_http_log.addHandler(RateLimitCounter())
+
+# Priority classes for OutboundQueue, most important first.
+CRITICAL, NORMAL, COSMETIC = 0, 1, 2
+priority_names = {CRITICAL: "critical", NORMAL: "normal", COSMETIC: "cosmetic"}
+
+class OutboundRequest:
+    def __init__(self, priority, call, args, kwargs, coalesce_key):
+        self.priority = priority
+        self.call = call
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.futures = [discord_client.loop.create_future()]
+        self.timing = perf.current()
+        self.queued_at = time.monotonic()
+        self.started = False
+        self.replaced = False
+
+    def resolve(self, result=None, error=None):
+        for future in self.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
 
-    member_roles = get_user_member(user).roles
+class OutboundQueue:
+    """
+    Every write the bot makes to Discord goes through here.
+
+    Requests are split into buckets by route (the kind of request and
+    the channel or server it's for), roughly matching Discord's own
+    rate limit buckets. Each bucket sends one request at a time, taking
+    CRITICAL requests (passwords, vote results) before NORMAL ones and
+    COSMETIC ones (countdown edits) last, so when we're rate limited the
+    important messages aren't stuck behind timer edits. An edit to a
+    message which already has an edit waiting replaces it, and both
+    callers get the result of the newer edit.
+
+    The methods mirror discord_client's and return awaitables.
+    """
 
-    has_role = False
-    for role in member_roles:
-        if role == get_custom_role():
-            has_role = True
-            break
+    def __init__(self):
+        self.queues = {}
+        self.workers = {}
+        self.coalescing = {}
+        self.counter = itertools.count()
+        self.coalesced = 0
+        self.wait_times = {i: deque(maxlen=200) for i in priority_names}
+
+    def submit(self, route, priority, call, *args, coalesce_key=None,
+               **kwargs):
+        request = OutboundRequest(priority, call, args, kwargs, coalesce_key)
+
+        if coalesce_key is not None:
+            queued = self.coalescing.get(coalesce_key)
+            if queued is not None and not queued.started:
+                queued.replaced = True
+                request.priority = min(priority, queued.priority)
+                request.futures.extend(queued.futures)
+                request.queued_at = queued.queued_at
+                self.coalesced += 1
+            self.coalescing[coalesce_key] = request
+
+        requests = self.queues.setdefault(route, [])
+        heapq.heappush(requests, (request.priority, next(self.counter), request))
+
+        worker = self.workers.get(route)
+        if worker is None or worker.done():
+            self.workers[route] = discord_client.loop.create_task(
+                self.drain(route))
+
+        return request.futures[0]
+
+    async def drain(self, route):
+        requests = self.queues[route]
+        while requests:
+            _, _, request = heapq.heappop(requests)
+            if request.replaced:
+                continue
+
+            request.started = True
+            if self.coalescing.get(request.coalesce_key) is request:
+                del self.coalescing[request.coalesce_key]
+            self.wait_times[request.priority].append(
+                time.monotonic() - request.queued_at)
+
+            # Any 429 while this runs counts against the request's command.
+            perf.set_current(request.timing)
+            try:
+                result = await request.call(*request.args, **request.kwargs)
+            except Exception as error:
+                if (isinstance(error, discord.HTTPException)
+                        and error.response.status == 429):
+                    perf.rate_limit()
+                request.resolve(error=error)
+            else:
+                request.resolve(result)
+            perf.rest_call(request.timing)
+            perf.set_current(None)
+
+        del self.queues[route]
+
+    def stats(self):
+        """Queued requests, coalesced edits and wait times per priority."""
+        stats = {"depth": sum(len(i) for i in self.queues.values()),
+                 "coalesced": self.coalesced}
+        for priority, name in priority_names.items():
+            wait_times = list(self.wait_times[priority]) or [0]
+            stats[name + "_avg_wait"] = sum(wait_times) / len(wait_times)
+            stats[name + "_max_wait"] = max(wait_times)
+        return stats
+
+    def send_message(self, destination, content=None, *, embed=None,
+                     priority=NORMAL):
+        return self.submit(("send", destination.id), priority,
+                           discord_client.send_message, destination,
+                           content, embed=embed)
+
+    def edit_message(self, message, new_content=None, *, embed=None,
+                     priority=NORMAL):
+        return self.submit(("edit", message.channel.id), priority,
+                           discord_client.edit_message, message, new_content,
+                           embed=embed, coalesce_key=("edit", message.id))
+
+    def delete_message(self, message, priority=NORMAL):
+        return self.submit(("delete", message.channel.id), priority,
+                           discord_client.delete_message, message)
+
+    def delete_messages(self, messages, priority=NORMAL):
+        return self.submit(("bulk_delete", messages[0].channel.id), priority,
+                           discord_client.delete_messages, messages)
+
+    def add_reaction(self, message, emoji, priority=NORMAL):
+        return self.submit(("reaction", message.channel.id), priority,
+                           discord_client.add_reaction, message, emoji)
+
+    def clear_reactions(self, message, priority=NORMAL):
+        return self.submit(("reaction", message.channel.id), priority,
+                           discord_client.clear_reactions, message)
+
+    def edit_channel(self, channel, priority=NORMAL, **options):
+        return self.submit(("channel", channel.id), priority,
+                           discord_client.edit_channel, channel, **options)
+
+    def add_roles(self, member, *roles, priority=NORMAL):
+        return self.submit(("roles", member.server.id), priority,
+                           discord_client.add_roles, member, *roles)
+
+    def remove_roles(self, member, *roles, priority=NORMAL):
+        return self.submit(("roles", member.server.id), priority,
+                           discord_client.remove_roles, member, *roles)
+
+    def pin_message(self, message, priority=NORMAL):
+        return self.submit(("pins", message.channel.id), priority,
+                           discord_client.pin_message, message)
+
+    def unpin_message(self, message, priority=NORMAL):
+        return self.submit(("pins", message.channel.id), priority,
+                           discord_client.unpin_message, message)
+
+outbound = OutboundQueue()
+
+class Countdown:
+    """
+    A single live countdown message, owned by the CountdownScheduler.
 
-    return has_role
+    template is either a format string with one {} for the mm:ss time,
+    or a callable taking the time string and returning the message text.
+    With no template the message isn't edited, for countdowns shown on
+    a SessionDashboard instead. deadline is the hard deadline; wait()
+    returns at that time whether or not the message edits have kept up.
+    """
 
-async def add_custom_role(user):
+    def __init__(self, scheduler, message, template, seconds, start=None):
+        if start is None:
+            start = datetime.datetime.now()
+
+        self.scheduler = scheduler
+        self.message = message
+        self.template = template
+        self.seconds = seconds
+        self.deadline = start + datetime.timedelta(seconds=seconds)
+        self.last_text = message.content
+        self.pending_edit = None
+        # Edits count towards the command which started the countdown.
+        self.timing = perf.current()
+
+    def remaining(self, now=None):
+        """Seconds left until the deadline, never negative."""
+        if now is None:
+            now = datetime.datetime.now()
+        return max((self.deadline - now).total_seconds(), 0)
+
+    def time_string(self, now=None):
+        # Rounding up must never show more time than the countdown started
+        # with, or a 25 second timer would briefly jump up to 00:30.
+        display_seconds = min(
+            self.scheduler.display_seconds(self.remaining(now)), self.seconds)
+        return get_countdown_string(datetime.timedelta(seconds=display_seconds))
+
+    def render(self, now=None):
+        time_string = self.time_string(now)
+        if callable(self.template):
+            return self.template(time_string)
+        return self.template.format(time_string)
+
+    def tick(self, now):
+        """Edit the message if its text has changed since the last edit."""
+        # A throttled edit is still in flight, so don't stack another
+        # behind it; the next tick will pick up the latest text instead.
+        if self.template is None:
+            return
+        if self.pending_edit is not None and not self.pending_edit.done():
+            return
+
+        new_text = self.render(now)
+        if new_text == self.last_text:
+            return
+
+        self.last_text = new_text
+        self.pending_edit = perf.spawn(self.edit(new_text), self.timing)
+
+    async def edit(self, new_text):
+        try:
+            await outbound.edit_message(self.message, new_text,
+                                        priority=COSMETIC)
+        except discord.HTTPException as error:
+            print("Countdown edit failed:", error)
+
+    async def wait(self):
+        """
+        Sleep until the hard deadline, then stop updating the message.
+        Any edit still in flight is awaited so it can't land on top of
+        whatever the caller posts next.
+        """
+        remaining = self.remaining()
+        try:
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+        finally:
+            self.scheduler.remove(self)
+
+        if self.pending_edit is not None and not self.pending_edit.done():
+            await asyncio.wait([self.pending_edit])
+
+class CountdownScheduler:
+    """
+    Keeps every live countdown message up to date from one loop.
+
+    Rather than each command editing its message every second, the
+    displayed time is rounded up to the nearest coarse_interval seconds
+    until the final fine_window seconds, and a message is only edited
+    when its rendered text changes. A 2 minute vote therefore costs
+    around 20 edits instead of 120.
+    """
+
+    def __init__(self, coarse_interval=10, fine_window=10):
+        self.coarse_interval = coarse_interval
+        self.fine_window = fine_window
+        self.countdowns = []
+        self.ticker = None
+
+    def display_seconds(self, remaining):
+        """Round remaining seconds up to the current update cadence."""
+        seconds = math.ceil(remaining)
+        if seconds > self.fine_window:
+            seconds = (math.ceil(seconds / self.coarse_interval)
+                       * self.coarse_interval)
+        return seconds
+
+    def start(self, message, template, seconds, start=None):
+        """
+        Start tracking an already-posted countdown message. The deadline
+        is seconds after start, which defaults to now.
+        """
+        countdown = Countdown(self, message, template, seconds, start)
+        self.add(countdown)
+        return countdown
+
+    def add(self, countdown):
+        """
+        Tick anything with a tick(now) method every second, until it's
+        removed.
+        """
+        self.countdowns.append(countdown)
+
+        if self.ticker is None or self.ticker.done():
+            self.ticker = discord_client.loop.create_task(self.run())
+
+    def remove(self, countdown):
+        if countdown in self.countdowns:
+            self.countdowns.remove(countdown)
+
+    async def run(self):
+        while self.countdowns:
+            now = datetime.datetime.now()
+            for countdown in list(self.countdowns):
+                countdown.tick(now)
+
+            # Tick on whole seconds so the final 10 seconds tick evenly.
+            await asyncio.sleep(1 - now.microsecond / 1000000)
+
+countdown_scheduler = CountdownScheduler()
+
+async def resume_countdown(message, template, seconds, deadline):
+    """
+    Carry on a countdown that was running when the bot stopped, if it
+    hasn't already run out. Returns once the deadline is reached.
+    """
+    if deadline <= datetime.datetime.now():
+        return
+
+    start = deadline - datetime.timedelta(seconds=seconds)
+    countdown = countdown_scheduler.start(message, template, seconds,
+                                          start=start)
+    await countdown.wait()
+
+async def fetch_message(channel, message_id):
+    """A message by ID, or None if it's been deleted."""
+    try:
+        return await discord_client.get_message(channel, message_id)
+    except discord.NotFound:
+        return None
+
+class ReactionTally:
+    """
+    Live reaction counts for open votes, built from the raw gateway
+    reaction events as they arrive so results are ready the moment a
+    vote closes without refetching the message.
+
+    Votes are stored per message as {emoji key: set of user IDs}, so a
+    repeated event from the same user is only counted once. Reactions
+    from the bot itself (the options it seeds) are never counted.
+    """
+
+    def __init__(self):
+        self.messages = {}
+
+    def watch(self, message_id, emoji_keys):
+        self.messages[message_id] = {i: set() for i in emoji_keys}
+
+    def unwatch(self, message_id):
+        self.messages.pop(message_id, None)
+
+    def is_watched(self, message_id):
+        return message_id in self.messages
+
+    def add(self, message_id, key, user_id):
+        voters = self.messages[message_id].get(key)
+        if voters is not None and user_id != discord_client.user.id:
+            voters.add(user_id)
+
+    def remove(self, message_id, key, user_id):
+        voters = self.messages[message_id].get(key)
+        if voters is not None:
+            voters.discard(user_id)
+
+    def counts(self, message_id):
+        """Returns {emoji key: number of votes} for a watched message."""
+        return {key: len(voters)
+                for key, voters in self.messages[message_id].items()}
+
+    def voters(self, message_id):
+        """Number of different users who voted on a watched message."""
+        return len(set().union(*self.messages[message_id].values()))
+
+reaction_tally = ReactionTally()
+
+all_emojis = {}
+
+def refresh_emojis():
+    # Region emojis can live on other servers, so look at all of them.
+    all_emojis.clear()
+    all_emojis.update((emoji.id, emoji)
+                      for emoji in discord_client.get_all_emojis())
+
+class ServerState:
+    """
+    Everything the bot keeps for one server: its settings from
+    config.json, the server objects used on every command and event
+    (looked up once rather than searched for each time), its role queue
+    and the votes currently open on it.
+
+    refresh() is run in on_ready, and the relevant part is refreshed
+    again whenever Discord tells us the server, its roles or channels
+    have changed. role_members holds the IDs of every member with the
+    custom role, kept up to date from member updates, so checking
+    whether someone has the role is a set lookup.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.id = config["serverID"]
+        self.server = None
+        self.custom_role = None
+        self.channels = {}
+        self.voice_channels = []
+        self.role_members = set()
+        self.active_votes = {}  # vote message ID: vote log name
+        self.role_queue = RoleQueue(self)
+
+    def refresh(self):
+        self.server = discord_client.get_server(self.id)
+        if self.server is None:
+            # Not available yet, or handled by another shard.
+            return
+
+        self.refresh_roles()
+        self.refresh_channels()
+
+    def refresh_roles(self):
+        self.custom_role = discord.utils.get(self.server.roles,
+                                             id=self.config["customRoleID"])
+        self.role_members = {member.id for member in self.server.members
+                             if self.custom_role in member.roles}
+
+    def refresh_channels(self):
+        self.channels = {name: self.server.get_channel(channel_id)
+                         for name, channel_id
+                         in self.config["channels"].items()}
+        self.voice_channels = [channel for channel in self.server.channels
+                               if channel.name.startswith("\U0001F6E0")]
+
+    def update_member(self, member):
+        if self.custom_role in member.roles:
+            self.role_members.add(member.id)
+        else:
+            self.role_members.discard(member.id)
+
+def get_custom_role(state):
+    return state.custom_role
+
+def get_user_member(state, user):
+    return state.server.get_member(user.id)
+
+def has_custom_role(state, user):
+    return user.id in state.role_members
+
+async def add_custom_role(state, user):
     """
     Add custom role to a user if they don't already have it.
     Returns True if role was newly added.
     """
 
-    if has_custom_role(user):
+    if has_custom_role(state, user):
         return False
     else:
-        custom_role = get_custom_role()
-        user_member = get_user_member(user)
-        await discord_client.add_roles(user_member, custom_role)
+        custom_role = get_custom_role(state)
+        user_member = get_user_member(state, user)
+        await outbound.add_roles(user_member, custom_role)
+        state.role_members.add(user_member.id)
         return True
 
-async def remove_custom_role(user):
+async def remove_custom_role(state, user):
     """
     Remove custom role from a user if they have it.
     Returns True if role was removed.
     """
 
-    if has_custom_role(user):
-        custom_role = get_custom_role()
-        user_member = get_user_member(user)
-        await discord_client.remove_roles(user_member, custom_role)
+    if has_custom_role(state, user):
+        custom_role = get_custom_role(state)
+        user_member = get_user_member(state, user)
+        await outbound.remove_roles(user_member, custom_role)
+        state.role_members.discard(user_member.id)
         return True
     else:
         return False
 
-@discord_client.event
+class RoleQueue:
+    """
+    Role changes from reactions on a server's role message, applied by
+    a single background worker at a steady pace.
+
+    Changes are coalesced per user, so if someone reacts and unreacts
+    several times before the worker gets to them only their final
+    state is applied. Members are looked up in the cached server rather
+    than fetched, and rate limited or failed requests are retried with
+    exponential backoff.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, state, interval=0.25, max_attempts=5, backoff=1):
+        self.state = state
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.pending = OrderedDict()  # user ID: (add role?, time queued)
+        self.wakeup = asyncio.Event()
+        self.worker = None
+        self.applied = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=200)
+
+    def put(self, user_id, add):
+        """Queue adding (or removing) the custom role for a user."""
+        if user_id in self.pending:
+            # Keep their place in the queue, but only the latest state.
+            queued_at = self.pending[user_id][1]
+        else:
+            queued_at = time.monotonic()
+        self.pending[user_id] = (add, queued_at)
+
+        if self.worker is None or self.worker.done():
+            self.worker = discord_client.loop.create_task(self.run())
+        self.wakeup.set()
+
+    def stats(self):
+        """Queue depth, totals and latency (seconds from event to applied)."""
+        latencies = list(self.latencies) or [0]
+        return {"depth": len(self.pending),
+                "applied": self.applied,
+                "failed": self.failed,
+                "avg_latency": sum(latencies) / len(latencies),
+                "max_latency": max(latencies)}
+
+    async def run(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            user_id, (add, queued_at) = self.pending.popitem(last=False)
+            await self.apply(user_id, add)
+            self.latencies.append(time.monotonic() - queued_at)
+
+            await asyncio.sleep(self.interval)
+
+    async def apply(self, user_id, add):
+        server = self.state.server
+        member = server.get_member(user_id) if server else None
+        if member is None:
+            return
+
+        for attempt in range(self.max_attempts):
+            try:
+                if add:
+                    changed = await add_custom_role(self.state, member)
+                    log_text = "role | reaction | granted new role"
+                else:
+                    changed = await remove_custom_role(self.state, member)
+                    log_text = "remove | reaction | removed role"
+                self.applied += 1
+                if changed:
+                    log_event(log_text, member, datetime.datetime.utcnow())
+                return
+            except discord.HTTPException as error:
+                status = getattr(error.response, "status", None)
+                if (status not in self.retry_statuses
+                        or attempt == self.max_attempts - 1):
+                    print("Role change failed for", user_id, error)
+                    self.failed += 1
+                    return
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+server_states = OrderedDict()
+
+# Role message ID: the ServerState it gives the custom role on.
+role_messages = {}
+
+def apply_server_configs(config):
+    """
+    Bring server_states in line with config.json, at startup and on
+    every reload. Servers already running keep their state (role queue,
+    open votes) and just pick up their new settings.
+    """
+    server_configs = OrderedDict((i["serverID"], i)
+                                 for i in load_server_configs(config))
+
+    for server_id in list(server_states):
+        if server_id not in server_configs:
+            del server_states[server_id]
+
+    for server_id, server_config in server_configs.items():
+        state = server_states.get(server_id)
+        if state is None:
+            # Before login there's nothing to look up yet, and on_ready
+            # refreshes every server anyway.
+            state = server_states[server_id] = ServerState(server_config)
+        else:
+            state.config = server_config
+        state.refresh()
+
+    role_messages.clear()
+    role_messages.update((state.config["reactionMessageID"], state)
+                         for state in server_states.values()
+                         if state.config.get("reactionMessageID"))
+
+
+def server_state(server):
+    """The ServerState for a Discord server, or None if it isn't one of ours."""
+    if server is None:
+        return None
+    return server_states.get(server.id)
+
+def member_states(user):
+    """The ServerStates of every server of ours the user is a member of."""
+    return [state for state in server_states.values()
+            if state.server is not None
+            and state.server.get_member(user.id) is not None]
+
+@bot_event
 async def on_ready():
 
     print('Logged in as', discord_client.user.name)
@@ -182,33 +1526,298 @@ async def on_ready():
         print(server.name)
     print('-----')
 
-    await twitch_check()
+    for state in server_states.values():
+        state.refresh()
+    refresh_emojis()
+
+    # on_ready fires again after reconnects, but each vote and timer is
+    # only resumed once and only one poller or file watcher runs.
+    discord_client.loop.create_task(active_store.resume())
+    twitch_status.start()
+    perf.start()
+    config_file.start()
+    bot_text.start()
+    session_file.start()
+
+@bot_event
+async def on_server_update(before, after):
+    state = server_state(after)
+    if state:
+        state.refresh()
+
+@bot_event
+async def on_server_available(server):
+    state = server_state(server)
+    if state:
+        state.refresh()
+        discord_client.loop.create_task(active_store.resume())
+
+@bot_event
+async def on_server_role_create(role):
+    state = server_state(role.server)
+    if state:
+        state.refresh_roles()
+
+@bot_event
+async def on_server_role_delete(role):
+    state = server_state(role.server)
+    if state:
+        state.refresh_roles()
+
+@bot_event
+async def on_server_role_update(before, after):
+    # Only the custom role matters; the member set is unaffected by edits.
+    state = server_state(after.server)
+    if state and after.id == state.config["customRoleID"]:
+        state.custom_role = after
+
+@bot_event
+async def on_channel_create(channel):
+    state = server_state(channel.server)
+    if state:
+        state.refresh_channels()
+
+@bot_event
+async def on_channel_delete(channel):
+    state = server_state(channel.server)
+    if state:
+        state.refresh_channels()
+
+@bot_event
+async def on_channel_update(before, after):
+    # Limit edits don't change which channels we use, only renames do.
+    state = server_state(after.server)
+    if state and before.name != after.name:
+        state.refresh_channels()
+
+@bot_event
+async def on_server_emojis_update(before, after):
+    refresh_emojis()
+
+@bot_event
+async def on_member_update(before, after):
+    state = server_state(after.server)
+    if state:
+        state.update_member(after)
+
+@bot_event
+async def on_member_remove(member):
+    state = server_state(member.server)
+    if state:
+        state.role_members.discard(member.id)
+
+class TokenBucket:
+    """Allows bursts of up to capacity, refilling one token every per seconds."""
+
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.per = per
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) / self.per)
+        self.updated = now
+        return self.tokens
+
+    def take(self):
+        """Use up a token, if there's one to use."""
+        if self.refill() < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def is_full(self):
+        return self.refill() >= self.capacity
+
+def get_bucket(buckets, key, capacity, per, max_buckets):
+    """
+    The TokenBucket for key in buckets, made if needed. Buckets which
+    have refilled are dropped once there are more than max_buckets.
+    """
+    bucket = buckets.get(key)
+    if bucket is None:
+        if len(buckets) >= max_buckets:
+            for old_key in [k for k, v in buckets.items() if v.is_full()]:
+                del buckets[old_key]
+        bucket = buckets[key] = TokenBucket(capacity, per)
+    return bucket
+
+class CommandThrottle:
+    """
+    Per-user and per-channel token buckets for the public chat commands
+    ($schedule, $twitch). A command only runs if both its user and its
+    channel have a token to spare, so a crowd spamming $schedule gets
+    one reply per channel per window rather than one each.
+
+    Throttled command messages aren't answered or logged, and are
+    removed together in one bulk delete per channel tidy_delay seconds
+    later. Buckets which have refilled are dropped once there are more
+    than max_buckets of them.
+    """
+
+    def __init__(self, user_capacity=2, user_per=60, channel_capacity=1,
+                 channel_per=30, tidy_delay=5, max_buckets=1000):
+        self.user_capacity = user_capacity
+        self.user_per = user_per
+        self.channel_capacity = channel_capacity
+        self.channel_per = channel_per
+        self.tidy_delay = tidy_delay
+        self.max_buckets = max_buckets
+        self.users = {}
+        self.channels = {}
+        self.to_delete = {}  # channel ID: throttled messages
+        self.tidiers = {}
+
+    def allow(self, message):
+        """Take a token for the message's user and channel if both have one."""
+        user_bucket = get_bucket(self.users, message.author.id,
+                                 self.user_capacity, self.user_per,
+                                 self.max_buckets)
+        channel_bucket = get_bucket(self.channels, message.channel.id,
+                                    self.channel_capacity, self.channel_per,
+                                    self.max_buckets)
+        if user_bucket.refill() < 1 or channel_bucket.refill() < 1:
+            return False
+        return user_bucket.take() and channel_bucket.take()
+
+    def throttled(self, message):
+        """Queue a throttled command message to be deleted."""
+        channel = message.channel
+        self.to_delete.setdefault(channel.id, []).append(message)
+
+        tidier = self.tidiers.get(channel.id)
+        if tidier is None or tidier.done():
+            self.tidiers[channel.id] = discord_client.loop.create_task(
+                self.tidy(channel))
+
+    async def tidy(self, channel):
+        await asyncio.sleep(self.tidy_delay)
+        messages = self.to_delete.pop(channel.id, [])
+        # Bulk deletes take 2 to 100 messages.
+        for i in range(0, len(messages), 100):
+            chunk = messages[i:i + 100]
+            try:
+                if len(chunk) == 1:
+                    await outbound.delete_message(chunk[0], priority=COSMETIC)
+                else:
+                    await outbound.delete_messages(chunk, priority=COSMETIC)
+            except discord.HTTPException as error:
+                print("Couldn't remove throttled commands:", error)
+
+command_throttle = CommandThrottle()
+throttled_commands = ("schedule", "twitch")
+
+# {case folded command name or alias: the name or alias as registered},
+# with whether it's hoster only. Built by create_bot().
+command_table = {}
+command_pattern = re.compile(r"\$(\S+)")
+
+# What on_message did with each guild message starting with $.
+dispatch_stats = {"unknown": 0, "unauthorized": 0, "throttled": 0,
+                  "dispatched": 0}
+
+def build_command_table(client):
+    command_table.clear()
+    for invoker, command in client.commands.items():
+        hoster = any(getattr(check, "hoster_only", False)
+                     for check in command.checks)
+        command_table[invoker.casefold()] = (invoker, command.name, hoster)
+
+class DebugLog:
+    """
+    Prints each accepted command when debugCommands is set in
+    config.json, at most capacity lines every per seconds. Lines over
+    the limit are counted and the count printed with the next line.
+    """
+
+    def __init__(self, capacity=10, per=1):
+        self.bucket = TokenBucket(capacity, per)
+        self.suppressed = 0
 
-@discord_client.event
+    def write(self, text):
+        if not config_file.data.get("debugCommands"):
+            return
+        if not self.bucket.take():
+            self.suppressed += 1
+            return
+        if self.suppressed:
+            print("({} lines suppressed)".format(self.suppressed))
+            self.suppressed = 0
+        print(text)
+
+debug_log = DebugLog()
+
+@bot_event
 async def on_message(message):
     # Handle DMs to the bot
-    if message.server is None and not message.author.bot:
-            await parse_pm(message)
-    else:
-        # Case insensitive commands. We have to make sure the rest of
-        # the command isn't lower case so as not to alter passwords.
-        # Since we're taking additional actions on raw input messages,
-        # we do a quick check that this is actually a command attempt
-        # so as not to needlessly process every server message.
-        if message.content.startswith("$"):
-            message_split = message.content.split(" ")
-            message_joined = message_split[0].lower() + " " + " ".join(message_split[1:])
-            print(message_joined)
-            message.content = message_joined
-
-        # Since we're overriding default on_message behaviour for the
-        # commands extension, this line is required.
-        await discord_client.process_commands(message)
-
-@discord_client.event
+    if message.server is None:
+        if not message.author.bot:
+            dm_pipeline.put(message)
+        return
+
+    # Only commands from people are of interest, and they're looked up
+    # case insensitively in the prebuilt command table before anything
+    # else is done with the message.
+    match = command_pattern.match(message.content)
+    if match is None or message.author.bot:
+        return
+
+    entry = command_table.get(match.group(1).casefold())
+    if entry is None:
+        dispatch_stats["unknown"] += 1
+        return
+    invoker, command_name, hoster = entry
+
+    if hoster and not in_hoster_channel(message):
+        dispatch_stats["unauthorized"] += 1
+        return
+
+    if command_name in throttled_commands:
+        if not command_throttle.allow(message):
+            dispatch_stats["throttled"] += 1
+            command_throttle.throttled(message)
+            return
+
+    dispatch_stats["dispatched"] += 1
+    perf.message_received(message)
+
+    # Only the command word is normalised; the rest of the message is
+    # left as it is so as not to alter passwords.
+    if match.group(1) != invoker:
+        message.content = "$" + invoker + message.content[match.end():]
+    debug_log.write(message.content)
+
+    # Since we're overriding default on_message behaviour for the
+    # commands extension, this line is required.
+    await discord_client.process_commands(message)
+
+reaction_events = ("MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE")
+
+# Frames seen, frames rejected before/after parsing, and reaction frames
+# acted on by on_socket_raw_receive.
+gateway_stats = {"seen": 0, "skipped": 0, "handled": 0}
+
+def is_watched_reaction_frame(raw_msg):
+    """
+    Cheap substring checks on a raw gateway frame, so the bulk of
+    traffic (presences, typing, chat messages) is thrown away without
+    being parsed. Only frames which look like a reaction on a role
+    message or an open vote get through to json.loads().
+    """
+    if "MESSAGE_REACTION_" not in raw_msg:
+        return False
+
+    watched_ids = list(role_messages)
+    watched_ids.extend(reaction_tally.messages)
+    return any('"{}"'.format(i) in raw_msg for i in watched_ids)
+
+@bot_event
 async def on_socket_raw_receive(raw_msg):
     """
-    For adding roles based on reaction.
+    For adding roles based on reaction, and counting votes as they come in.
     discord.py async release can only use on_reaction_add() to monitor
     reactions to messages in its cache (i.e. sent recently, while it is
     online). Rewrite has on_raw_reaction_add() which removes this limitation,
@@ -216,426 +1825,921 @@ async def on_socket_raw_receive(raw_msg):
     """
     if not isinstance(raw_msg, str):
         return
+
+    gateway_stats["seen"] += 1
+    if not is_watched_reaction_frame(raw_msg):
+        gateway_stats["skipped"] += 1
+        return
+
     msg = json.loads(raw_msg)
     type = msg.get("t")
     data = msg.get("d")
-    if not data:
+    if type not in reaction_events or not data:
+        gateway_stats["skipped"] += 1
         return
 
+    gateway_stats["handled"] += 1
     message_id = data.get("message_id")
-    if message_id == config_data["reactionMessageID"]:
+    if reaction_tally.is_watched(message_id):
+        key = gateway_emoji_key(data.get("emoji", {}))
         user_id = data.get("user_id")
         if type == "MESSAGE_REACTION_ADD":
-            user = await discord_client.get_user_info(user_id)
-            await add_custom_role(user)
+            reaction_tally.add(message_id, key, user_id)
         elif type == "MESSAGE_REACTION_REMOVE":
-            user = await discord_client.get_user_info(user_id)
-            await remove_custom_role(user)
+            reaction_tally.remove(message_id, key, user_id)
+    elif message_id in role_messages:
+        role_messages[message_id].role_queue.put(
+            data.get("user_id"), add=type == "MESSAGE_REACTION_ADD")
 
-async def parse_pm(message_object):
+class SeenUsers:
     """
-    When users send a DM to the bot, first check if they sent any
-    before now. If not, first send instructions. Otherwise, parse
-    whatever command they sent.
+    IDs of every user who has DMed the bot before, so we know whether to
+    send them instructions without fetching their DM history.
+
+    Held in memory and backed by a file of one ID per line, which is
+    read once at startup and appended to (in an executor) as new users
+    message the bot.
     """
 
-    pm_commands = ['role', 'schedule', 'twitch', 'forms', 'remove']
-    pm_response = text_data["pmResponses"]["primary"]
-    pm_channel = message_object.channel
+    def __init__(self, path):
+        self.path = path
+        self.user_ids = set()
+
+        if os.path.isfile(path):
+            with open(path) as file:
+                self.user_ids = {line.strip() for line in file if line.strip()}
+
+    def __contains__(self, user_id):
+        return user_id in self.user_ids
+
+    def add(self, user_id):
+        if user_id in self.user_ids:
+            return
+        self.user_ids.add(user_id)
+        discord_client.loop.run_in_executor(None, self.append, user_id)
+
+    def append(self, user_id):
+        with open(self.path, "a") as file:
+            file.write(user_id + "\n")
+
+seen_users = SeenUsers(os.path.join(log_folder, "seen_users.txt"))
 
-    dm_content = message_object.content.lower()
+async def has_messaged_before(user, pm_channel):
+    """
+    Whether this DM is not the user's first. Users we haven't seen since
+    the seen users file was started fall back to checking their DM
+    history; our instructions reply means any earlier DM leaves at least
+    two messages there.
+    """
+    if user.id in seen_users:
+        return True
 
     num_pms = 0
     async for _ in discord_client.logs_from(pm_channel, limit=2):
         num_pms += 1
 
-    if num_pms > 1:
+    seen_users.add(user.id)
+    return num_pms > 1
+
+pm_commands = ('role', 'schedule', 'twitch', 'forms', 'remove')
+
+def render_pm_replies(text):
+    """
+    Every DM reply, ready to send. The Twitch reply has a version for
+    each stream status (live, offline and unknown).
+    """
+    replies = dict(text["pmResponses"])
+    replies["unknown"] = "Sorry, I don't recognise that command."
+    replies["twitch"] = {
+        live: stream_status_text(text["pmResponses"]["twitch"], live, text)
+        for live in (None, True, False)}
+    return replies
+
+async def parse_pm(message_object, dm_content):
+    """
+    When users send a DM to the bot, first check if they sent any
+    before now. If not, first send instructions. Otherwise, parse
+    whatever command they sent. dm_content is the lower case command.
+    """
+    replies = bot_text.rendered("pm_replies", render_pm_replies)
+    pm_channel = message_object.channel
+
+    if await has_messaged_before(message_object.author, pm_channel):
         if dm_content in pm_commands:
+            # DMs aren't tied to a server, so apply role changes on
+            # every one of ours the user is in.
             if dm_content == 'role':
-                role_added = await add_custom_role(message_object.author)
+                role_added = False
+                for state in member_states(message_object.author):
+                    if await add_custom_role(state, message_object.author):
+                        role_added = True
                 if role_added:
-                    pm_text = text_data["pmResponses"]["roleSuccess"]
+                    pm_text = replies["roleSuccess"]
                     log_text = "role | DM | granted new role"
                 else:
-                    pm_text = text_data["pmResponses"]["rolePresent"]
+                    pm_text = replies["rolePresent"]
                     log_text = "role | DM"
             elif dm_content == 'remove':
-                role_removed = await remove_custom_role(message_object.author)
+                role_removed = False
+                for state in member_states(message_object.author):
+                    if await remove_custom_role(state, message_object.author):
+                        role_removed = True
                 if role_removed:
-                    pm_text = text_data["pmResponses"]["removeSuccess"]
+                    pm_text = replies["removeSuccess"]
                     log_text = "remove | DM | removed role"
                 else:
-                    pm_text = text_data["pmResponses"]["removeFailure"]
+                    pm_text = replies["removeFailure"]
                     log_text = "remove | DM"
+            elif dm_content == 'twitch':
+                pm_text = replies["twitch"][twitch_status.is_live()]
+                log_text = message_object.content + "| DM"
             else:
-                pm_text = text_data["pmResponses"][dm_content]
+                pm_text = replies[dm_content]
                 log_text = message_object.content + "| DM"
 
-            await discord_client.send_message(pm_channel, content=pm_text)
+            await outbound.send_message(pm_channel, content=pm_text)
             log_command(message_object, log_text)
 
         else:
-            error_message = "Sorry, I don't recognise that command."
-            await discord_client.send_message(pm_channel, content=error_message)
+            await outbound.send_message(pm_channel, content=replies["unknown"])
             log_command(message_object, message_object.content + " | DM", error=True)
 
     else:
-        await discord_client.send_message(pm_channel, content=pm_response)
+        await outbound.send_message(pm_channel, content=replies["primary"])
         log_command(message_object, "Sent instructions | DM")
 
-@discord_client.command(name='squadvote', aliases=['sqv'], pass_context=True)
-@hoster_only()
-async def squad_vote(ctx, *args):
+class DMPipeline:
     """
-    Starts a vote on squad size.
-
-    The hoster can specify squad sizes to be used, or 'all' to include
-    every size between 1 and 10. If there are no arguments, the vote
-    defaults to 1, 2, 4, and 8. The vote stays open for 2 minutes.
-
-    Once a winner is determined, set_voice_limit() is run for the
-    winning size.
+    DMs to the bot, answered by a pool of workers so that a crowd all
+    told to "DM the bot role" can't swamp it.
+
+    DMs wait in a queue with an entry per user, holding each different
+    command they've sent in order. A repeat of a command which is still
+    waiting is merged into it, so ten "role"s make one role change and
+    one reply. Each user's commands are handled by one worker at a time,
+    so "role" then "remove" can't race. Every other new command takes a
+    token from the user's bucket, and is dropped if they have none left
+    or max_pending users are already waiting. The first command dropped
+    for being over a user's limit gets a reply asking them to slow down;
+    the rest are ignored until they have a token again.
     """
-    message_object = ctx.message
-    message_channel = ctx.message.channel
-    message_squad_sizes = args
-    
-    if len(message_squad_sizes) == 0:
-        default_squad_sizes = [1, 2, 4, 8]
-        squad_sizes_selected = default_squad_sizes
-    else:
-        if message_squad_sizes[0] == "all":
-            squad_sizes_selected = range(1,11)
-        else:
-            try:
-                sizes_selected = [int(i) for i in message_squad_sizes]
-                squad_sizes_selected = sorted(sizes_selected)
-            except ValueError:
-                error_message = ("Error: Please only use integers"
-                                 " as arguments for `squadvote`.")
-                await discord_client.send_message(message_channel,
-                                          content= error_message)
-                return
-
-            squads_correct_range = all(i >= 1 and i <= 10
-                                       for i in squad_sizes_selected)
-            if not squads_correct_range:
-                error_message = ("Error: Please only use integers"
-                                 " between 1 and 10 for `squadvote`.")
-                await discord_client.send_message(message_channel,
-                                          content= error_message)
-                return
-
-    customs_channel = get_custom_games()
-
-    squad_vote_message = ("Please vote on squad size for the next game:"
-                          "\nTimer: {}")
-    default_message = squad_vote_message.format("02:00")
-    
-    sent_squad_message = await discord_client.send_message(customs_channel,
-                                                   content= default_message)
-
-    for squad_size_int in squad_sizes_selected:
-        if squad_size_int == 10:
-            emoji = "\U0001F51F"  # :keycap_ten: is a single emoji
-        else:
-            emoji = str(squad_size_int) + "\U000020E3"
-
-        await discord_client.add_reaction(sent_squad_message, emoji)
-
-    here_ping = await discord_client.send_message(customs_channel,
-                                          content="@here")
-
-    await discord_client.send_message(message_channel,
-                              content= "Squad size vote successfully posted.")
-    log_command(message_object, "Squad vote")
-
-    time_to_post = datetime.datetime.now() + datetime.timedelta(seconds=120)
-
-    while datetime.datetime.now() < time_to_post:
-        countdown_timer = time_to_post - datetime.datetime.now()
-        countdown_timer_string = get_countdown_string(countdown_timer)
-        await asyncio.sleep(1)
-        new_message = squad_vote_message.format(countdown_timer_string)
-        await discord_client.edit_message(sent_squad_message, new_message)
-
-    sent_squad_message = await discord_client.get_message(customs_channel,
-                                                  sent_squad_message.id)
-    await discord_client.clear_reactions(sent_squad_message)
-
-    squad_selected = most_reactions(sent_squad_message, num_only=True)
-
-    squad_result = squad_selected + "P Squads"
 
-    squad_message_finished = "Squad size vote over. Result: {}".format(squad_result)
+    def __init__(self, workers=4, max_pending=1000, user_capacity=3,
+                 user_per=3, max_buckets=5000):
+        self.num_workers = workers
+        self.max_pending = max_pending
+        self.user_capacity = user_capacity
+        self.user_per = user_per
+        self.max_buckets = max_buckets
+        self.pending = OrderedDict()  # user ID: {command: (message, time)}
+        self.active = set()  # Users a worker is handling right now.
+        self.buckets = {}
+        self.warned = set()  # Users told to slow down since their last token.
+        self.wakeup = asyncio.Event()
+        self.workers = []
+        self.received = 0
+        self.coalesced = 0
+        self.rate_limited = 0
+        self.dropped = 0
+        self.handled = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=200)
+
+    def put(self, message):
+        """Queue a DM, unless it's a repeat, rate limited or there's no room."""
+        self.received += 1
+        user_id = message.author.id
+        dm_content = message.content.strip().lower()
+
+        commands = self.pending.get(user_id)
+        if commands is not None and dm_content in commands:
+            # Keep its place in the queue, but answer the latest message.
+            commands[dm_content] = (message, commands[dm_content][1])
+            self.coalesced += 1
+            return
 
-    await discord_client.edit_message(sent_squad_message, squad_message_finished)
+        if commands is None and len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
 
-    await discord_client.delete_message(here_ping)
+        bucket = get_bucket(self.buckets, user_id, self.user_capacity,
+                            self.user_per, self.max_buckets)
+        if not bucket.take():
+            self.rate_limited += 1
+            if user_id not in self.warned:
+                if len(self.warned) >= self.max_buckets:
+                    self.warned.clear()
+                self.warned.add(user_id)
+                discord_client.loop.create_task(self.slow_down(message))
+            return
+        self.warned.discard(user_id)
 
-    if len(squad_selected) > 1:
-        voice_limit_int = int(squad_selected[:-1])  # Unicode to int
-    else:
-        voice_limit_int = 10
+        self.pending.setdefault(user_id, OrderedDict())[dm_content] = (
+            message, time.monotonic())
 
-    await ctx.invoke(set_voice_limit, user_limit=voice_limit_int)
+        if not any(not i.done() for i in self.workers):
+            self.workers = [discord_client.loop.create_task(self.run())
+                            for _ in range(self.num_workers)]
+        self.wakeup.set()
 
-@discord_client.command(name='regionvote', aliases=['rv'], pass_context=True)
-@hoster_only()
-async def region_vote(ctx):
+    async def slow_down(self, message):
+        try:
+            await outbound.send_message(
+                message.channel,
+                content=bot_text.data["pmResponses"]["slowDown"],
+                priority=COSMETIC)
+        except discord.HTTPException as error:
+            print("Couldn't answer DM:", repr(error))
+
+    def next_user(self):
+        """The user who's waited longest and isn't already being handled."""
+        return next((i for i in self.pending if i not in self.active), None)
+
+    async def run(self):
+        while True:
+            user_id = self.next_user()
+            if user_id is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            commands = self.pending.pop(user_id)
+            self.active.add(user_id)
+            try:
+                for dm_content, (message, queued_at) in commands.items():
+                    try:
+                        await parse_pm(message, dm_content)
+                        self.handled += 1
+                    except Exception as error:
+                        self.failed += 1
+                        print("Couldn't answer DM:", repr(error))
+                    self.latencies.append(time.monotonic() - queued_at)
+            finally:
+                self.active.discard(user_id)
+                # Anything they sent meanwhile can be picked up now.
+                if user_id in self.pending:
+                    self.wakeup.set()
+
+    def stats(self):
+        """Backlog, totals and latency (seconds from DM to reply)."""
+        latencies = list(self.latencies) or [0]
+        return {"depth": sum(len(i) for i in self.pending.values()),
+                "received": self.received,
+                "coalesced": self.coalesced,
+                "rate_limited": self.rate_limited,
+                "dropped": self.dropped,
+                "handled": self.handled,
+                "failed": self.failed,
+                "avg_latency": sum(latencies) / len(latencies),
+                "max_latency": max(latencies)}
+
+dm_pipeline = DMPipeline()
+
+def resolve_emoji(emoji):
     """
-    Starts a vote on region to host on.
-
-    Hoster has no control over this one; it just adds every region's emoji
-    and determines the winner.
+    Vote definitions use unicode emojis directly and custom server emojis
+    by ID. Returns something add_reaction() accepts.
     """
-    region_emoji_ids = config_data["regionEmojis"]
-
-
-    customs_channel = get_custom_games()
+    if emoji.isdigit():
+        return all_emojis.get(emoji)
+    return emoji
 
-    region_vote_message = ("Which region should we host today's games on?"
-                           "\nTimer: {}")
-    default_region_message = region_vote_message.format("02:00")
-    region_message = await discord_client.send_message(customs_channel,
-                                               content= default_region_message)
-
-    for region_emoji in region_emoji_ids:
-        region_emoji_obj = discord.utils.get(discord_client.get_all_emojis(),
-                                             id=region_emoji)
-        await discord_client.add_reaction(region_message, region_emoji_obj)
-
-    here_ping = await discord_client.send_message(customs_channel,
-                                          content="@here")
+def emoji_key(emoji):
+    """
+    Unicode emojis are keyed by themselves, custom emojis by ID. The
+    variation selector is dropped since gateway events and our own
+    emoji strings don't always agree on including it.
+    """
+    if isinstance(emoji, str):
+        return emoji.replace("\U0000FE0F", "")
+    return emoji.id
 
-    message_channel = ctx.message.channel
-    await discord_client.send_message(message_channel,
-                              "Region vote successfully posted.")
-    log_command(ctx.message, "Region vote")
-    time_to_post = datetime.datetime.now() + datetime.timedelta(seconds=120)
+def gateway_emoji_key(emoji_data):
+    """emoji_key() for the emoji object in a raw reaction event."""
+    return emoji_data.get("id") or emoji_key(emoji_data.get("name", ""))
 
-    while datetime.datetime.now() < time_to_post:
-        countdown_timer = time_to_post - datetime.datetime.now()
-        countdown_timer_string = get_countdown_string(countdown_timer)
-        await asyncio.sleep(1)
-        new_message = region_vote_message.format(countdown_timer_string)
-        await discord_client.edit_message(region_message, new_message)
+def load_vote_definitions():
+    """
+    Read every vote type from votes.json. Each definition holds the
+    vote's text, its options (key, label, emoji, value and whether it's
+    included by default), duration, result format and an optional
+    onResult hook name from vote_result_hooks. Options taken from a
+    server's config (optionsFromConfig) are filled in per server by
+    vote_options().
+    """
+    with open(vote_definitions_path) as file:
+        definitions = json.load(file, object_pairs_hook=OrderedDict)
 
-    region_message = await discord_client.get_message(customs_channel,
-                                              region_message.id)
-    await discord_client.clear_reactions(region_message)
-    region_selected = most_reactions(region_message)
+    for vote_name, definition in definitions.items():
+        definition["name"] = vote_name
+        for option in definition.get("options", []):
+            option.setdefault("label", option["key"])
+            option.setdefault("value", option["key"])
 
-    region_result = region_selected
+    return definitions
 
-    region_message_finished = "Region vote over. Result: {}".format(region_result)
+def server_options(state, options):
+    """
+    Options with any custom emojis given by name in a server's config
+    ("Yes", "One_five", ...) swapped for their IDs on that server.
+    """
+    emoji_ids = state.config.get("emojis", {})
+    return [dict(i, emoji=emoji_ids.get(i["emoji"], i["emoji"]))
+            for i in options]
+
+def vote_options(definition, state):
+    """Every option a vote definition has on a server."""
+    config_key = definition.get("optionsFromConfig")
+    if config_key:
+        return [{"key": emoji_id, "label": emoji_id, "emoji": emoji_id,
+                 "value": emoji_id, "default": True}
+                for emoji_id in state.config[config_key]]
+    return server_options(state, definition["options"])
+
+def select_vote_options(vote_name, all_options, args):
+    """
+    Pick which options to put up for a vote from the hoster's arguments.
+    No arguments means the default options, 'all' means every option.
+    Returns (options, error_message).
+    """
+    if not all_options:
+        error_message = ("Error: `{}` has no options set up on this "
+                         "server.".format(vote_name))
+        return None, error_message
+    if len(args) == 0:
+        options = [i for i in all_options if i.get("default", True)]
+        if not options:
+            error_message = ("Error: `{}` has no default options, so please "
+                             "give the options to vote on.".format(vote_name))
+            return None, error_message
+        return options, None
+    if args[0].lower() == "all":
+        return list(all_options), None
+
+    options_by_key = {i["key"].lower(): i for i in all_options}
+    unknown = [i for i in args if i.lower() not in options_by_key]
+    if unknown:
+        error_message = "Error: Valid options for `{}` are: {}."
+        error_message = error_message.format(
+            vote_name, ", ".join(i["key"] for i in all_options))
+        return None, error_message
+
+    selected_keys = {i.lower() for i in args}
+    return [i for i in all_options if i["key"].lower() in selected_keys], None
+
+def option_fields(option):
+    """An option's fields for use in format strings, emoji resolved."""
+    fields = dict(option)
+    fields["emoji"] = resolve_emoji(option["emoji"])
+    return fields
+
+def watch_vote(message, options):
+    """Start counting reactions on a vote message as they arrive."""
+    reaction_tally.watch(message.id, [emoji_key(i["emoji"]) for i in options])
+
+async def seed_reactions(message, options):
+    """
+    Add every option's reaction to a vote message. They're all queued at
+    once, so they go out back to back in order as fast as the reaction
+    rate limit allows rather than waiting on each other.
+    """
+    await asyncio.gather(*[outbound.add_reaction(message,
+                                                 resolve_emoji(i["emoji"]))
+                           for i in options])
 
-    await discord_client.delete_message(here_ping)
+def option_votes(message, options):
+    """Returns {option key: votes} for a watched vote message."""
+    counts = reaction_tally.counts(message.id)
+    return OrderedDict((i["key"], counts[emoji_key(i["emoji"])])
+                       for i in options)
 
-    await discord_client.edit_message(region_message, region_message_finished)
+def reaction_votes(message, options):
+    """
+    Returns {option key: votes} counted from a fetched message's
+    reactions, for votes whose live tally missed events while the bot
+    was down. The bot's own seeded reactions aren't counted.
+    """
+    counts = {emoji_key(i.emoji): i.count - int(i.me)
+              for i in message.reactions}
+    return OrderedDict((i["key"], counts.get(emoji_key(i["emoji"]), 0))
+                       for i in options)
 
-@discord_client.command(name='mapvote', aliases=['mv'], pass_context=True)
-@hoster_only()
-async def map_vote(ctx, *args):
+class VoteTally:
+    """
+    The full result of a vote: each option's votes and share, turnout,
+    and which options tied for the most votes.
+
+    Ties are broken by a random.Random seeded with the vote message's
+    ID, which is saved with the result, so the same counts always give
+    the same winner and any tie-break can be checked afterwards. vote
+    is the vote command's name, or the setting's name in a full vote.
+    message is None for a full vote setting whose message has gone,
+    which is tallied as no votes and not saved.
     """
-    Starts a vote on which Map to play.
 
-    The hoster can specify which maps to vote, or 'all' to include
-    every map. The vote stays open for 2 minutes.
+    def __init__(self, vote, votes, message, voters=None):
+        self.vote = vote
+        self.counts = OrderedDict(votes)
+        self.message_id = message.id if message else None
+        self.server_id = (message.server.id
+                          if message and message.server else None)
+        self.total = sum(self.counts.values())
+        # Distinct people who voted, where we know it; otherwise votes.
+        self.turnout = self.total if voters is None else voters
+
+        # A full vote setting with no options has no winner, and falls
+        # back to its default like one nobody voted on.
+        max_votes = max(self.counts.values(), default=0)
+        self.tied = [key for key, count in self.counts.items()
+                     if count == max_votes]
+        self.seed = self.message_id
+        self.winner = (random.Random(self.seed).choice(self.tied)
+                       if self.tied else None)
+
+    def share(self, key):
+        """Fraction of all votes cast which went to key."""
+        return self.counts[key] / self.total if self.total else 0
+
+    def is_tie(self):
+        return len(self.tied) > 1
+
+    def records(self):
+        """Rows for the vote_results and vote_counts tables."""
+        result = (self.message_id, self.vote, self.server_id, self.winner,
+                  self.total, self.turnout, len(self.tied), self.seed)
+        counts = [(self.message_id, key, count)
+                  for key, count in self.counts.items()]
+        return result, counts
+
+def tally_summary(tally, options):
+    """
+    A line for under a vote's result: each option's share of the votes
+    and the turnout, and whether the winner was drawn from a tie.
+    """
+    if tally.total == 0:
+        return "No votes were cast, so the result was picked at random."
+
+    labels = {i["key"]: str(resolve_emoji(i["emoji"]) or i["key"])
+              for i in options}
+    shares = ", ".join("{} {:.0%}".format(labels[key], tally.share(key))
+                       for key, count in tally.counts.items() if count)
+    text = "Votes: {} ({} voters)".format(shares, tally.turnout)
+    if tally.is_tie():
+        text += "\nTied, so the winner was drawn at random."
+    return text
+
+def live_tally(vote, message, options):
+    """VoteTally for a watched vote message, from the live reaction tally."""
+    return VoteTally(vote, option_votes(message, options), message,
+                     voters=reaction_tally.voters(message.id))
+
+def live_vote_template(vote_template, message, options):
+    """
+    Countdown template which also shows the option currently in the
+    lead. The leader is only looked up when the time shown changes, so
+    it rides along with the countdown's edits rather than adding more.
+    """
+    options_by_key = {i["key"]: i for i in options}
+    rendered = {}
+
+    def render(time_string):
+        if time_string not in rendered:
+            tally = live_tally(None, message, options)
+            text = vote_template.format(time_string)
+            if tally.total > 0:
+                leader = options_by_key[tally.winner]
+                text += "\nCurrently leading: {}".format(
+                    resolve_emoji(leader["emoji"]))
+            rendered.clear()
+            rendered[time_string] = text
+        return rendered[time_string]
+
+    return render
+
+def format_vote_options(definition, options):
+    option_format = definition.get("optionFormat")
+    if not option_format:
+        return ""
+    return "".join(option_format.format(**option_fields(i)) for i in options)
+
+async def stage_vote(state, definition, options, text):
+    """
+    Post a vote's message with text in place of the timer and start
+    seeding its reactions, ready for run_vote() to start its countdown.
+    Votes are counted from here on. Returns (message, seeding task).
+    """
+    vote_text = (definition["prompt"]
+                 + format_vote_options(definition, options) + "\n" + text)
+    vote_message = await outbound.send_message(get_custom_games(state),
+                                               content=vote_text)
+    watch_vote(vote_message, options)
+    state.active_votes[vote_message.id] = definition["log"]
+    seeding = perf.spawn(seed_reactions(vote_message, options))
+    return vote_message, seeding
+
+async def run_vote(ctx, definition, options, staged=None, ping=True,
+                   dashboard=None):
+    """
+    Post a vote in #custom-games, count down, then edit in the winner.
+    Every vote type goes through here; only the definition differs.
+    A vote already posted with stage_vote() can be passed as staged.
+    $session does its own @here ping rather than one per vote, and
+    shows the time left and leader on its dashboard rather than in
+    the vote's message. Returns the winning option.
     """
-    message_object = ctx.message
     message_channel = ctx.message.channel
-    message_maps_choice = args
-    maps_for_vote = "" 
-    emojis = ""
-    map_choice_selected = ""
-    maps_available = ['Erangel', 'Miramar', 'Sanhok', 'Vikendi', 'Camp Jackal']
-
-    if len(message_maps_choice) == 0:
-        map_choice_selected = maps_available
-        emojis = ['\U0001F3DE','\U0001F3DC','\U0001F3DD','\U0001F3D4']
-        maps_for_vote = ("\nErangel = \U0001F3DE"
-                         "\nMiramar = \U0001F3DC"
-                         "\nSanhok = \U0001F3DD"
-                         "\nVikendi = \U0001F3D4")
-    
-    #if any(s in message_maps_choice for s in maps_available):
-    #    pass
-    #else:
-    #    maps = " ".join(maps_available)
-    #    error_message = ("Error: Can't find one or more maps. \nMaps available are: ") + maps
-    #    await discord_client.send_message(message_channel, content=error_message)
-    #    return
-
-    if 'Erangel' in message_maps_choice:
-        map_choice_selected = map_choice_selected + "Erangel"
-        emojis = emojis + "\U0001F3DE"
-        maps_for_vote = maps_for_vote + "\nErangel: \U0001F3DE"
-    if 'Miramar' in message_maps_choice:
-        map_choice_selected = map_choice_selected + "Miramar"
-        emojis = emojis + "\U0001F3DC"
-        maps_for_vote = maps_for_vote + "\nMiramar: \U0001F3DC"
-    if 'Sanhok' in message_maps_choice:
-        map_choice_selected = map_choice_selected + "Sanhok"
-        emojis = emojis + "\U0001F3DD"
-        maps_for_vote = maps_for_vote + "\nSanhok: \U0001F3DD"
-    if 'Vikendi' in message_maps_choice:
-        map_choice_selected = map_choice_selected + "Vikendi"
-        emojis = emojis + "\U0001F3D4"
-        maps_for_vote = maps_for_vote + "\nVikendi: \U0001F3D4"
-    if 'Jackal' in message_maps_choice:
-        map_choice_selected = map_choice_selected + "Camp Jackal"
-        emojis = emojis + "\U0001F304"
-        maps_for_vote = maps_for_vote + "\nCamp Jackal: \U0001F304"
+    state = server_state(ctx.message.server)
+    customs_channel = get_custom_games(state)
 
-    
-    customs_channel = get_custom_games()
-
-    maps_vote_message = ("Please vote on which map you want to play for the next game:") + maps_for_vote + ("\nTimer: {}")
-    default_message = maps_vote_message.format("02:00")
-    
-    sent_map_message = await discord_client.send_message(customs_channel,
-                                                   content= default_message)
+    options_list = format_vote_options(definition, options)
+    vote_template = definition["prompt"] + options_list + "\nTimer: {}"
+    duration = definition.get("duration", 120)
 
-    for emoji in emojis:
-        await discord_client.add_reaction(sent_map_message, emoji)
-
-    here_ping = await discord_client.send_message(customs_channel,
-                                          content="@here")
-
-    await discord_client.send_message(message_channel,
-                              content= "Map vote successfully posted." + maps_for_vote)
-    log_command(message_object, "Map vote")
+    command_start = time.monotonic()
+    if dashboard is not None:
+        timer_text = "Timer: " + dashboard_time_text
+    else:
+        timer_text = "Timer: " + get_countdown_string(
+            datetime.timedelta(seconds=duration))
+    if staged is None:
+        staged = await stage_vote(state, definition, options, timer_text)
+    vote_message, seeding = staged
+    posted_at = datetime.datetime.now()
+
+    # The timer runs from when the vote was posted, or opened if it was
+    # staged. Reactions, the @here ping and the hoster's confirmation
+    # all go out alongside it.
+    if dashboard is not None:
+        countdown = countdown_scheduler.start(vote_message, None, duration,
+                                              start=posted_at)
+        dashboard.start(definition["log"], countdown,
+                        vote=(definition["name"], vote_message, options))
+    else:
+        countdown = countdown_scheduler.start(
+            vote_message,
+            live_vote_template(vote_template, vote_message, options),
+            duration, start=posted_at)
+    announcements = [outbound.send_message(
+        message_channel, content=definition["posted"] + options_list)]
+    if ping:
+        announcements.append(outbound.send_message(customs_channel,
+                                                   content="@here"))
+    # A staged vote's message only changes once it's opened.
+    vote_text = vote_template.format(dashboard_time_text)
+    if dashboard is not None and vote_message.content != vote_text:
+        announcements.append(outbound.edit_message(vote_message, vote_text))
+
+    # Only a vote which opened properly is saved to be finished after a
+    # restart.
+    try:
+        sent = await asyncio.gather(*announcements)
+        await seeding
+    except Exception:
+        countdown_scheduler.remove(countdown)
+        abandon_vote(state, vote_message)
+        raise
+    here_ping = sent[1] if ping else None
+    active_store.add("vote", vote_message, countdown.deadline, state,
+                     vote=definition["name"],
+                     ping=here_ping.id if here_ping else None,
+                     options=[i["key"] for i in options])
+
+    seeding_time = time.monotonic() - command_start
+    log_command(ctx.message, "{} | seeded in {:.2f}s".format(definition["log"],
+                                                            seeding_time))
+
+    await countdown.wait()
+
+    tally = live_tally(definition["name"], vote_message, options)
+    winner = await finish_vote(state, definition, options, vote_message,
+                               here_ping, tally, countdown.deadline)
+    log_command(ctx.message, definition["log"] + " result",
+                result=winner["key"], tally=tally)
+
+    return winner
+
+async def finish_vote(state, definition, options, vote_message, here_ping,
+                      tally, deadline=None):
+    """
+    Edit the winner into a vote which has closed, tidy up after it and
+    run its onResult hook. Shared by run_vote() and votes resumed after
+    a restart. Returns the winning option. If the vote's deadline is
+    given, how late the result went out is recorded.
+    """
+    reaction_tally.unwatch(vote_message.id)
+    state.active_votes.pop(vote_message.id, None)
+    winner = {i["key"]: i for i in options}[tally.winner]
 
-    time_to_post = datetime.datetime.now() + datetime.timedelta(seconds=120)
+    await outbound.clear_reactions(vote_message)
 
-    while datetime.datetime.now() < time_to_post:
-        countdown_timer = time_to_post - datetime.datetime.now()
-        countdown_timer_string = get_countdown_string(countdown_timer)
-        await asyncio.sleep(1)
-        new_message = maps_vote_message.format(countdown_timer_string)
-        await discord_client.edit_message(sent_map_message, new_message)
+    result_text = (definition["result"].format(**option_fields(winner))
+                   + "\n" + tally_summary(tally, options))
 
-    sent_map_message = await discord_client.get_message(customs_channel,
-                                                  sent_map_message.id)
-    await discord_client.clear_reactions(sent_map_message)
+    await outbound.edit_message(vote_message, result_text, priority=CRITICAL)
+    if deadline is not None:
+        perf.countdown_finished(definition["log"], deadline)
+    if here_ping is not None:
+        await outbound.delete_message(here_ping)
+    active_store.remove(vote_message)
 
-    map_selected = most_reactions(sent_map_message)
+    hoster_channel = state.channels.get("hoster")
+    if definition.get("announceResult"):
+        await outbound.send_message(hoster_channel, result_text)
 
-    map_result = map_selected
+    hook_name = definition.get("onResult")
+    if hook_name:
+        await vote_result_hooks[hook_name](state, hoster_channel, winner)
 
-    map_message_finished = "Map vote over. Result: {}".format(map_result)
+    return winner
 
-    await discord_client.edit_message(sent_map_message, map_message_finished)
-    await discord_client.send_message(message_channel, map_message_finished)
-    await discord_client.delete_message(here_ping)
+def abandon_vote(state, vote_message):
+    """Stop counting a vote which won't be finished, and forget it."""
+    reaction_tally.unwatch(vote_message.id)
+    state.active_votes.pop(vote_message.id, None)
+    active_store.remove(vote_message)
 
-@discord_client.command(name='perspectivevote', aliases=['pv'], pass_context=True)
-@hoster_only()
-async def perspective_vote(ctx):
+async def resume_vote(state, vote_message, deadline, data):
     """
-    Starts a vote on perspective for the game mode.
-
+    Finish a vote that was open when the bot stopped. The live tally
+    missed whatever happened while we were down, so the result is
+    counted from the message's reactions once the deadline is reached.
     """
+    definition = vote_definitions[data["vote"]]
+    options = [i for i in vote_options(definition, state)
+               if i["key"] in data["options"]]
+    if not options:
+        # They've all been removed from votes.json or the server's config.
+        print("Can't finish", definition["log"], vote_message.id,
+              "with none of its options left")
+        return
+    vote_template = (definition["prompt"]
+                     + format_vote_options(definition, options)
+                     + "\nTimer: {}")
+    state.active_votes[vote_message.id] = definition["log"]
+
+    await resume_countdown(vote_message, vote_template,
+                           definition.get("duration", 120), deadline)
+
+    vote_id = vote_message.id
+    vote_message = await fetch_message(vote_message.channel, vote_id)
+    if vote_message is None:
+        state.active_votes.pop(vote_id, None)
+        return
+    here_ping = None
+    if data["ping"] is not None:
+        here_ping = await fetch_message(vote_message.channel, data["ping"])
+    tally = VoteTally(definition["name"],
+                      reaction_votes(vote_message, options), vote_message)
+    winner = await finish_vote(state, definition, options, vote_message,
+                               here_ping, tally)
+    log_event(definition["log"] + " result | resumed", discord_client.user,
+              datetime.datetime.utcnow(), result=winner["key"], tally=tally)
+
+async def voice_limit_hook(state, hoster_channel, winner):
+    await apply_voice_limit(state, hoster_channel, winner["value"])
+
+vote_result_hooks = {"set_voice_limit": voice_limit_hook}
+
+def make_vote_command(vote_name, definition):
+    async def vote_command(ctx, *args):
+        state = server_state(ctx.message.server)
+        options, error_message = select_vote_options(
+            vote_name, vote_options(definition, state), args)
+        if error_message:
+            await outbound.send_message(ctx.message.channel,
+                                        content=error_message)
+            return
 
-    customs_channel = get_custom_games()
+        await run_vote(ctx, definition, options)
 
-    perspective_vote_message = ("Which perspective should the next game be played on?"
-                           "\nTimer: {}")
-    default_perspective_message = perspective_vote_message.format("02:00")
-    perspective_message = await discord_client.send_message(customs_channel,
-                                               content= default_perspective_message)
-    perspective_emojis = ['1','3']
-    
-    for perspective_int in perspective_emojis:
-        emoji = str(perspective_int) + "\U000020E3"
-        await discord_client.add_reaction(perspective_message, emoji)
-    here_ping = await discord_client.send_message(customs_channel,
-                                          content="@here")
+    vote_command.__doc__ = definition.get("help")
+    return vote_command
 
-    message_channel = ctx.message.channel
-    await discord_client.send_message(message_channel,
-                              "Perspective vote successfully posted.")
-    log_command(ctx.message, "Perspective vote")
-    time_to_post = datetime.datetime.now() + datetime.timedelta(seconds=120)
+vote_definitions = load_vote_definitions()
 
-    while datetime.datetime.now() < time_to_post:
-        countdown_timer = time_to_post - datetime.datetime.now()
-        countdown_timer_string = get_countdown_string(countdown_timer)
-        await asyncio.sleep(1)
-        new_message = perspective_vote_message.format(countdown_timer_string)
-        await discord_client.edit_message(perspective_message, new_message)
+for vote_name, vote_definition in vote_definitions.items():
+    vote_command = make_vote_command(vote_name, vote_definition)
+    bot_command(name=vote_name, aliases=vote_definition.get("aliases", []),
+                pass_context=True)(hoster_only()(vote_command))
 
-    perspective_message = await discord_client.get_message(customs_channel,
-                                              perspective_message.id)
-    await discord_client.clear_reactions(perspective_message)
-    perspective_selected = most_reactions(perspective_message)
+fullvote_labels = {"Yes": "On", "No": "Off", "One_five": "1.5",
+                   "Zero_five": "0.5", "Minus_one": "-1",
+                   "Minus_point_five": "-0.5"}
 
-    perspective_result = perspective_selected
+def keycap_emoji(number):
+    """Keycap emoji for 0-10. :keycap_ten: is a single emoji."""
+    if number == 10:
+        return "\U0001F51F"
+    return str(number) + "\U000020E3"
 
-    perspective_message_finished = "Perspective vote over. Result: {}".format(perspective_result)
+def load_fullvote():
+    """
+    Read fullvote.json: how long a full vote runs for in seconds, and
+    its game settings in the same option shape used by votes.json.
+    Numbers become keycap emojis and names refer to the custom emojis
+    in each server's config, which server_options() looks up when the
+    vote is posted. A file with just the settings at the top level, as
+    before, gets a 2 minute vote. Returns (duration, settings).
+    """
+    with open(fullvote_path) as file:
+        fullvote = json.load(file, object_pairs_hook=OrderedDict)
+    settings = fullvote.get("settings", fullvote)
+
+    for setting in settings.values():
+        options = []
+        for emoji_name in setting["emojis"]:
+            if isinstance(emoji_name, int):
+                emoji = keycap_emoji(emoji_name)
+                label = str(emoji_name)
+            else:
+                emoji = emoji_name
+                label = fullvote_labels.get(emoji_name, emoji_name)
+            options.append({"key": label, "label": label, "emoji": emoji,
+                            "value": label})
+        setting["options"] = options
 
-    await discord_client.delete_message(here_ping)
+    return fullvote.get("duration", 120), settings
 
-    await discord_client.edit_message(perspective_message, perspective_message_finished)
+def setting_result(setting, tally):
+    """
+    The winning value for a setting, formatted with its units, or its
+    default if nobody voted.
+    """
+    if tally.total == 0:
+        if not setting["default"]:
+            return "No preference"
+        return setting["default"] + setting["units"] + " (default)"
 
+    return tally.winner + setting["units"]
 
-@discord_client.command(name='warmodewepsvote', aliases=['wmw'], pass_context=True)
+fullvote_template = "Please vote on the settings for the next game:\nTimer: {}"
+
+@bot_command(name='fullvote', aliases=['fv'], pass_context=True)
 @hoster_only()
-async def perspective_vote(ctx):
-    """
-    Starts a vote which Warmode Weapons to implement in the next game.
-    """
-
-    customs_channel = get_custom_games()
-    warmodeweps_message = ("Which weapons should we include in war mode?")
-    warmodeweps_list = ("\n1. Default"
-                        "\n2. Bomb Kit (Throwables)"
-                        "\n3. VSS Kit"
-                        "\n4. OP Kit (Crate weapons)"
-                        "\n5. Sniper Kit"
-                        "\n")
-    warmodeweps_vote_message = warmodeweps_message + warmodeweps_list + ("\nTimer: {}")
-    default_warmodeweps_message = warmodeweps_vote_message.format("02:00")
-    warmodeweps_message = await discord_client.send_message(customs_channel,
-                                               content= default_warmodeweps_message)
-    warmodeweps_emojis = ['1','2', '3', '4', '5',]
-
-    for warmodeweps_int in warmodeweps_emojis:
-        emoji = str(warmodeweps_int) + "\U000020E3"
-        await discord_client.add_reaction(warmodeweps_message, emoji)
-    here_ping = await discord_client.send_message(customs_channel,
-                                          content="@here")
+async def full_vote(ctx):
+    """
+    Starts a vote on every game setting in fullvote.json at once.
 
+    Each setting gets its own message so it can have its own reactions,
+    but they share a single timer, as long as fullvote.json's duration
+    (2 minutes as shipped). Once it's over the setting messages are
+    removed and replaced with one embed of the results, using each
+    setting's default where nobody voted.
+    """
     message_channel = ctx.message.channel
-    await discord_client.send_message(message_channel,
-                              "Warmode Wepons vote successfully posted." + warmodeweps_list)
-    log_command(ctx.message, "Warmode Wepons vote")
-    time_to_post = datetime.datetime.now() + datetime.timedelta(seconds=120)
-
-    while datetime.datetime.now() < time_to_post:
-        countdown_timer = time_to_post - datetime.datetime.now()
-        countdown_timer_string = get_countdown_string(countdown_timer)
-        await asyncio.sleep(1)
-        new_message = warmodeweps_vote_message.format(countdown_timer_string)
-        await discord_client.edit_message(warmodeweps_message, new_message)
-
-    warmodeweps_message = await discord_client.get_message(customs_channel,
-                                              warmodeweps_message.id)
-    await discord_client.clear_reactions(warmodeweps_message)
-    warmodeweps_selected = most_reactions(warmodeweps_message)
-
-    warmodeweps_result = warmodeweps_selected
-
-    warmodeweps_message_finished = "Warmode Wepons vote over. \nResult: {}".format(warmodeweps_result)
+    state = server_state(ctx.message.server)
+    customs_channel = get_custom_games(state)
+
+    default_text = fullvote_template.format(get_countdown_string(
+        datetime.timedelta(seconds=fullvote_duration)))
+    command_start = time.monotonic()
+    header_message = await outbound.send_message(customs_channel,
+                                                 content=default_text)
+
+    # Messages have to be posted in order, but reactions don't need to
+    # wait for the rest of the messages before being added. The timer
+    # only starts once every setting is up, so the last ones posted get
+    # as long as the first.
+    setting_messages = OrderedDict()
+    setting_options = {}
+    seeding = []
+    countdown = None
+    try:
+        for setting_name, setting in fullvote_settings.items():
+            options = server_options(state, setting["options"])
+            setting_message = await outbound.send_message(
+                customs_channel, content="**{}**".format(setting["input"]))
+            setting_messages[setting_name] = setting_message
+            setting_options[setting_name] = options
+            watch_vote(setting_message, options)
+            state.active_votes[setting_message.id] = "Full vote"
+            seeding.append(perf.spawn(seed_reactions(setting_message,
+                                                     options)))
+        countdown = countdown_scheduler.start(
+            header_message, fullvote_template, fullvote_duration)
+
+        here_ping, _ = await asyncio.gather(
+            outbound.send_message(customs_channel, content="@here"),
+            outbound.send_message(
+                message_channel,
+                content="Full settings vote successfully posted."))
+        await asyncio.gather(*seeding)
+    except Exception:
+        if countdown is not None:
+            countdown_scheduler.remove(countdown)
+        for task in seeding:
+            task.cancel()
+        for setting_message in setting_messages.values():
+            abandon_vote(state, setting_message)
+        raise
+
+    # Only saved to be finished after a restart once it's fully open.
+    active_store.add("fullvote", header_message, countdown.deadline, state,
+                     ping=here_ping.id,
+                     settings={name: message.id for name, message
+                               in setting_messages.items()})
+
+    seeding_time = time.monotonic() - command_start
+    log_command(ctx.message, "Full vote | seeded in {:.2f}s".format(
+        seeding_time))
+
+    await countdown.wait()
+
+    setting_tallies = OrderedDict(
+        (setting_name, live_tally(setting_name, setting_message,
+                                  setting_options[setting_name]))
+        for setting_name, setting_message in setting_messages.items())
+    results = await finish_full_vote(state, header_message,
+                                     list(setting_messages.values()),
+                                     setting_tallies, here_ping,
+                                     countdown.deadline)
+    for setting_name, result in results.items():
+        log_command(ctx.message, "Full vote result | " + setting_name,
+                    result=result, tally=setting_tallies[setting_name])
+
+async def finish_full_vote(state, header_message, setting_messages,
+                           setting_tallies, here_ping, deadline=None):
+    """
+    Replace a closed full vote's setting messages with one embed of the
+    results, also sent to the hosters. Shared by full_vote() and full
+    votes resumed after a restart. Returns {setting name: result}.
+    """
+    results = OrderedDict()
+    results_embed = discord.Embed(title="Settings for the next game")
+    for setting_name, tally in setting_tallies.items():
+        setting = fullvote_settings[setting_name]
+        result = setting_result(setting, tally)
+        result_text = result
+        if tally.total:
+            result_text += " ({:.0%}{})".format(
+                tally.share(tally.winner), ", tied" if tally.is_tie() else "")
+        results_embed.add_field(name=setting["output"], value=result_text)
+        results[setting_name] = result
+
+    for setting_message in setting_messages:
+        reaction_tally.unwatch(setting_message.id)
+        state.active_votes.pop(setting_message.id, None)
+
+    # A resumed vote may only have one message left, and bulk deletes
+    # take 2 to 100 messages.
+    to_delete = [i for i in setting_messages + [here_ping] if i is not None]
+    if len(to_delete) == 1:
+        await outbound.delete_message(to_delete[0])
+    elif to_delete:
+        await outbound.delete_messages(to_delete)
+    await outbound.edit_message(header_message, "Settings vote over.",
+                                embed=results_embed, priority=CRITICAL)
+    if deadline is not None:
+        perf.countdown_finished("Full vote", deadline)
+    active_store.remove(header_message)
+    await outbound.send_message(state.channels.get("hoster"),
+                                embed=results_embed)
+
+    return results
+
+async def resume_full_vote(state, header_message, deadline, data):
+    """
+    Finish a full vote that was open when the bot stopped, counting each
+    setting from its message's reactions. Settings whose message has
+    gone fall back to their default.
+    """
+    channel = header_message.channel
+    for setting_id in data["settings"].values():
+        state.active_votes[setting_id] = "Full vote"
+
+    await resume_countdown(header_message, fullvote_template,
+                           fullvote_duration, deadline)
+
+    setting_messages = []
+    setting_tallies = OrderedDict()
+    for setting_name, setting in fullvote_settings.items():
+        options = server_options(state, setting["options"])
+        setting_message = None
+        if setting_name in data["settings"]:
+            setting_message = await fetch_message(
+                channel, data["settings"][setting_name])
+        if setting_message is None:
+            votes = OrderedDict((i["key"], 0) for i in options)
+        else:
+            setting_messages.append(setting_message)
+            votes = reaction_votes(setting_message, options)
+        setting_tallies[setting_name] = VoteTally(setting_name, votes,
+                                                  setting_message)
 
-    await discord_client.delete_message(here_ping)
+    for setting_id in data["settings"].values():
+        state.active_votes.pop(setting_id, None)
 
-    await discord_client.edit_message(warmodeweps_message, warmodeweps_message_finished)
-    await discord_client.send_message(message_channel, warmodeweps_message_finished)
+    here_ping = await fetch_message(channel, data["ping"])
+    results = await finish_full_vote(state, header_message, setting_messages,
+                                     setting_tallies, here_ping)
+    for setting_name, result in results.items():
+        log_event("Full vote result | " + setting_name + " | resumed",
+                  discord_client.user, datetime.datetime.utcnow(),
+                  result=result, tally=setting_tallies[setting_name])
 
+fullvote_duration, fullvote_settings = load_fullvote()
 
-@discord_client.command(name='password', pass_context=True)
+@bot_command(name='password', pass_context=True)
 @hoster_only()
 async def password_countdown(ctx, password, *args):
     """
@@ -650,7 +2754,7 @@ async def password_countdown(ctx, password, *args):
 
     if not password:
         error_message = "Error: Please enter a password."
-        await discord_client.send_message(message_channel, content=error_message)
+        await outbound.send_message(message_channel, content=error_message)
         return
 
     if len(args) == 0:
@@ -661,48 +2765,98 @@ async def password_countdown(ctx, password, *args):
         except ValueError:
             error_message = ("Error: Please use an integer to denote the "
                              "countdown length for `password`.")
-            await discord_client.send_message(message_channel, content=error_message)
+            await outbound.send_message(message_channel, content=error_message)
             return
     else:
         error_message = ("Error: Too many arguments.")
-        await discord_client.send_message(message_channel, content=error_message)
+        await outbound.send_message(message_channel, content=error_message)
         return
 
-    customs_channel = get_custom_games()
+    await run_password(ctx, password, num_seconds)
 
-    current_time = datetime.datetime.now()
-    time_to_post = current_time + datetime.timedelta(seconds=num_seconds)
-    countdown_timer = time_to_post - datetime.datetime.now()
+async def run_password(ctx, password, num_seconds, dashboard=None):
+    """
+    Post the password to SSSC, then count down to releasing it in
+    #custom-games. Used by $password and $session, which shows the
+    countdown on its dashboard.
+    """
+    state = server_state(ctx.message.server)
+    customs_channel = get_custom_games(state)
+
+    countdown_timer = datetime.timedelta(seconds=num_seconds)
     countdown_timer_string = get_countdown_string(countdown_timer)
 
-    template_string = "Server name: PUBG Reddit\nPassword: {}"
+    bracketed_template = password_template.format("[{}]")
 
-    default_text = template_string.format("[" + countdown_timer_string + "]")
-    result_string = template_string.format(password)
+    if dashboard is not None:
+        countdown_timer_string = dashboard_time_text
+    default_text = bracketed_template.format(countdown_timer_string)
+    result_string = password_template.format(password)
 
-    countdown_message = await discord_client.send_message(customs_channel,
-                                                  default_text)
+    countdown_message = await outbound.send_message(customs_channel,
+                                                    default_text)
 
     # Send password to SSSC channel first
-    sssc_channel = discord_client.get_channel(config_data["channels"]["sssc"])
-    await discord_client.send_message(sssc_channel, result_string)
-    await discord_client.send_message(sssc_channel, content="@here")
+    sssc_channel = state.channels["sssc"]
+    sssc_message = await outbound.send_message(sssc_channel, result_string,
+                                               priority=CRITICAL)
+    await outbound.send_message(sssc_channel, content="@here",
+                                priority=CRITICAL)
 
     log_command(ctx.message, "Password")
 
     # Password timer for custom-games channel
-    while datetime.datetime.now() < time_to_post:
-        countdown_timer = time_to_post - datetime.datetime.now()
-        countdown_timer_string = get_countdown_string(countdown_timer)
-        await asyncio.sleep(1)
-        string_bracketed = "[" + countdown_timer_string + "]"
-        new_message = template_string.format(string_bracketed)
-        await discord_client.edit_message(countdown_message, new_message)
-
-    await discord_client.edit_message(countdown_message, result_string)
-    await discord_client.send_message(customs_channel, content="@here")
-
-@discord_client.command(name='countdown', pass_context=True)
+    if dashboard is not None:
+        countdown = countdown_scheduler.start(countdown_message, None,
+                                              num_seconds)
+        dashboard.start("Password", countdown)
+    else:
+        countdown = countdown_scheduler.start(countdown_message,
+                                              bracketed_template, num_seconds)
+    # The password itself is never saved. If the bot restarts before
+    # it's released, it's copied from the SSSC message instead.
+    active_store.add("password", countdown_message, countdown.deadline, state,
+                     sssc=sssc_message.id, seconds=num_seconds)
+    await countdown.wait()
+
+    await finish_password(state, countdown_message, result_string,
+                          countdown.deadline)
+
+password_template = "Server name: PUBG Reddit\nPassword: {}"
+
+async def finish_password(state, countdown_message, result_string,
+                          deadline=None):
+    """
+    Release the password in #custom-games once its countdown is over.
+    result_string is the message with the password in, as posted to SSSC.
+    """
+    await outbound.edit_message(countdown_message, result_string,
+                                priority=CRITICAL)
+    if deadline is not None:
+        perf.countdown_finished("Password", deadline)
+    await outbound.send_message(get_custom_games(state), content="@here",
+                                priority=CRITICAL)
+    active_store.remove(countdown_message)
+
+async def resume_password(state, countdown_message, deadline, data):
+    await resume_countdown(countdown_message,
+                           password_template.format("[{}]"),
+                           data["seconds"], deadline)
+
+    if "password" in data:
+        # Saved before passwords were left out of active_store.
+        result_string = password_template.format(data["password"])
+    else:
+        sssc_message = await fetch_message(state.channels["sssc"],
+                                           data["sssc"])
+        if sssc_message is None:
+            print("Can't release password", countdown_message.id,
+                  "as its SSSC message has gone")
+            return
+        result_string = sssc_message.content
+    await finish_password(state, countdown_message, result_string)
+
+@bot_command(name='countdown', pass_context=True)
 @hoster_only()
 async def countdown_timer(ctx, *args):
     """
@@ -722,38 +2876,16 @@ async def countdown_timer(ctx, *args):
         except ValueError:
             error_message = ("Error: Please use an integer to denote the "
                              "countdown length.")
-            await discord_client.send_message(message_channel, content=error_message)
+            await outbound.send_message(message_channel, content=error_message)
             return
     else:
         error_message = ("Error: Too many arguments.")
-        await discord_client.send_message(message_channel, content=error_message)
+        await outbound.send_message(message_channel, content=error_message)
         return
 
-    customs_channel = get_custom_games()
-
-    current_time = datetime.datetime.now()
-    time_to_post = current_time + datetime.timedelta(seconds=num_seconds)
-    countdown_timer = time_to_post - datetime.datetime.now()
-    countdown_timer_string = get_countdown_string(countdown_timer)
-
-    template_string = "The next game will begin in: {}"
-
-    default_text = template_string.format(countdown_timer_string)
-
-    countdown_message = await discord_client.send_message(customs_channel,
-                                                  default_text)
-
-    while datetime.datetime.now() < time_to_post:
-        countdown_timer = time_to_post - datetime.datetime.now()
-        countdown_timer_string = get_countdown_string(countdown_timer)
-        await asyncio.sleep(1)
-        new_message = template_string.format(countdown_timer_string)
-        await discord_client.edit_message(countdown_message, new_message)
-
-    await discord_client.delete_message(countdown_message)
-    await discord_client.send_message(customs_channel, content="Game Started!")
+    await run_timer(ctx, "countdown", num_seconds)
 
-@discord_client.command(name='timer', pass_context=True)
+@bot_command(name='timer', pass_context=True)
 @hoster_only()
 async def timer(ctx, *args):
     """
@@ -771,45 +2903,453 @@ async def timer(ctx, *args):
         except ValueError:
             error_message = ("Error: Please use an integer to denote the "
                              "timer length.")
-            await discord_client.send_message(message_channel, content=error_message)
+            await outbound.send_message(message_channel, content=error_message)
             return
     else:
         error_message = ("Error: Too many arguments.")
-        await discord_client.send_message(message_channel, content=error_message)
+        await outbound.send_message(message_channel, content=error_message)
         return
 
-    customs_channel = get_custom_games()
+    await run_timer(ctx, "timer", num_seconds)
 
-    current_time = datetime.datetime.now()
-    time_to_post = current_time + datetime.timedelta(seconds=num_seconds)
-    timer = time_to_post - datetime.datetime.now()
+async def run_timer(ctx, timer_name, num_seconds, dashboard=None):
+    """
+    Post a $countdown or $timer in #custom-games and count it down.
+    timer_name is a key of timer_texts. A $session shows the time left
+    on its dashboard instead.
+    """
+    state = server_state(ctx.message.server)
+    customs_channel = get_custom_games(state)
+
+    timer = datetime.timedelta(seconds=num_seconds)
     timer_string = get_countdown_string(timer)
+    if dashboard is not None:
+        timer_string = dashboard_time_text
 
-    template_string = "A timer has started!\n{}"
+    template_string = timer_texts[timer_name][0]
 
     default_text = template_string.format(timer_string)
 
-    timer_message = await discord_client.send_message(customs_channel,
-                                                  default_text)
+    timer_message = await outbound.send_message(customs_channel,
+                                                default_text)
+
+    if dashboard is not None:
+        countdown = countdown_scheduler.start(timer_message, None,
+                                              num_seconds)
+        dashboard.start(timer_name.capitalize(), countdown)
+    else:
+        countdown = countdown_scheduler.start(timer_message, template_string,
+                                              num_seconds)
+    active_store.add("timer", timer_message, countdown.deadline, state,
+                     timer=timer_name, seconds=num_seconds)
+    await countdown.wait()
+
+    await finish_timer(state, timer_name, timer_message, countdown.deadline)
+
+# $countdown and $timer: (countdown template, text posted once it's over)
+timer_texts = {"countdown": ("The next game will begin in: {}",
+                             "Game Started!"),
+               "timer": ("A timer has started!\n{}", "Time's Up!")}
+
+async def finish_timer(state, timer_name, timer_message, deadline=None):
+    await outbound.delete_message(timer_message)
+    await outbound.send_message(get_custom_games(state),
+                                content=timer_texts[timer_name][1])
+    if deadline is not None:
+        perf.countdown_finished(timer_name.capitalize(), deadline)
+    active_store.remove(timer_message)
+
+async def resume_timer(state, timer_message, deadline, data):
+    await resume_countdown(timer_message, timer_texts[data["timer"]][0],
+                           data["seconds"], deadline)
+    await finish_timer(state, data["timer"], timer_message)
+
+session_path = os.path.join(file_path, 'session.json')
+
+def validate_session(session):
+    """
+    Check the $session pipeline in session.json. stages is a list of
+    stages, each a list of steps which run at the same time: a vote
+    ({"vote": name, optionally with "args" as given to its command}),
+    {"countdown": minutes} or {"password": minutes}. Each stage starts
+    once every step of the one before has finished, onResult hooks
+    included.
+    """
+    for key in ("announcement", "staged", "stageAhead", "stages"):
+        if key not in session:
+            raise ValueError("missing " + key)
+
+    for stage in session["stages"]:
+        if not stage:
+            raise ValueError("a stage has no steps")
+        for step in stage:
+            if "vote" in step:
+                if step["vote"] not in vote_definitions:
+                    raise ValueError("unknown vote " + step["vote"])
+            elif "countdown" not in step and "password" not in step:
+                raise ValueError("a step isn't a vote, countdown or password")
+
+session_file = JSONFile(session_path, validate_session)
+
+def stage_length(steps):
+    """Seconds until the longest step in a stage is over."""
+    return max(step["definition"].get("duration", 120) if "definition" in step
+               else step["seconds"] for step in steps)
+
+async def stage_session_votes(state, steps, delay, text):
+    """
+    After delay seconds, post every vote in steps ready to be opened,
+    with text in place of their timers.
+    """
+    await asyncio.sleep(max(delay, 0))
+    votes = [step for step in steps if "definition" in step]
+    staged = await asyncio.gather(*[
+        stage_vote(state, step["definition"], step["options"], text)
+        for step in votes],
+        return_exceptions=True)
+    # Votes which were posted are kept even if another wasn't, so the
+    # session can clean them up.
+    for step, staged_vote in zip(votes, staged):
+        if not isinstance(staged_vote, Exception):
+            step["staged"] = staged_vote
+    for staged_vote in staged:
+        if isinstance(staged_vote, Exception):
+            raise staged_vote
+
+# Shown in place of the time left in messages whose countdown is on a
+# SessionDashboard.
+dashboard_time_text = "see the session dashboard"
+
+class SessionDashboard:
+    """
+    One embed in #custom-games for everything a $session has going on:
+    each vote's time left, leader and tally, the password and game
+    countdowns, the voice channel size and whether the stream is live.
+
+    The session's votes and timers don't edit their own messages.
+    Instead the CountdownScheduler ticks the dashboard with the rest of
+    its countdowns, and it's edited at most once a tick, only when
+    what it shows has changed, so a session costs one stream of edits
+    rather than one per vote and timer. Tallies are recounted every
+    tally_interval seconds so votes coming in don't force an edit every
+    second.
+    """
+
+    def __init__(self, state, message, num_stages, tally_interval=5):
+        self.state = state
+        self.message = message
+        self.num_stages = num_stages
+        self.tally_interval = tally_interval
+        self.stage = 0
+        self.status = None
+        self.entries = OrderedDict()
+        self.tallies = {}
+        self.tallied_at = None
+        self.last_embed = None
+        self.pending_edit = None
+        self.timing = perf.current()
+
+    def add(self, label):
+        """List a step which hasn't started yet."""
+        self.entries[label] = {"countdown": None, "vote": None,
+                               "result": None}
+
+    def start(self, label, countdown, vote=None):
+        """
+        Show a step's countdown. vote is (name, message, options) for a
+        vote, whose leader is shown too.
+        """
+        self.entries[label].update(countdown=countdown, vote=vote)
+        self.tallied_at = None
+
+    def finish(self, label, result):
+        self.entries[label].update(countdown=None, result=result)
+
+    def leader_text(self, vote):
+        name, vote_message, options = vote
+        if not reaction_tally.is_watched(vote_message.id):
+            return ""
+        tally = live_tally(name, vote_message, options)
+        if tally.total == 0:
+            return "\nNo votes yet"
+        leader = {i["key"]: i for i in options}[tally.winner]
+        return "\nLeading: {} with {} of {} votes".format(
+            resolve_emoji(leader["emoji"]), tally.counts[tally.winner],
+            tally.total)
+
+    def render(self, now):
+        if (self.tallied_at is None
+                or (now - self.tallied_at).total_seconds()
+                >= self.tally_interval):
+            self.tallied_at = now
+            self.tallies = {label: self.leader_text(entry["vote"])
+                            for label, entry in self.entries.items()
+                            if entry["vote"] is not None}
+
+        description = self.status
+        if description is None:
+            description = "Stage {} of {}".format(self.stage + 1,
+                                                  self.num_stages)
+        embed = discord.Embed(title="Custom games session",
+                              description=description)
+        for label, entry in self.entries.items():
+            countdown = entry["countdown"]
+            if entry["result"] is not None:
+                value = entry["result"]
+            elif countdown is None:
+                value = "Up next"
+            elif countdown.remaining(now) > 0:
+                value = "{} left".format(countdown.time_string(now))
+                value += self.tallies.get(label, "")
+            else:
+                value = "Finishing..."
+            embed.add_field(name=label, value=value, inline=False)
+
+        voice_limits = sorted({i.user_limit
+                               for i in self.state.voice_channels})
+        embed.add_field(name="Voice channels",
+                        value=", ".join("{} players".format(i)
+                                        for i in voice_limits) or "None")
+        live = twitch_status.is_live()
+        embed.add_field(name="Stream",
+                        value={None: "Unknown", True: "Live",
+                               False: "Offline"}[live])
+        return embed
+
+    def tick(self, now):
+        if self.pending_edit is not None and not self.pending_edit.done():
+            return
+
+        embed = self.render(now)
+        if embed.to_dict() == self.last_embed:
+            return
+
+        self.last_embed = embed.to_dict()
+        self.pending_edit = perf.spawn(self.edit(embed), self.timing)
+
+    async def edit(self, embed):
+        try:
+            await outbound.edit_message(self.message, self.message.content,
+                                        embed=embed, priority=COSMETIC)
+        except discord.HTTPException as error:
+            print("Dashboard edit failed:", error)
+
+    async def close(self, status="Finished"):
+        """Stop updating, and leave the final state in place."""
+        countdown_scheduler.remove(self)
+        self.status = status
+        if self.pending_edit is not None and not self.pending_edit.done():
+            await asyncio.wait([self.pending_edit])
+        await self.edit(self.render(datetime.datetime.now()))
+
+def session_step_label(step):
+    """The name a session step is shown under on the dashboard."""
+    if "definition" in step:
+        return step["definition"]["log"]
+    elif "password" in step:
+        return "Password"
+    return "Countdown"
+
+async def run_session_step(ctx, step, dashboard):
+    """Run one step of a $session. Votes return their result text."""
+    if "definition" in step:
+        # Staged here if it wasn't already, so the session knows about
+        # every vote message it has posted.
+        if step["staged"] is None:
+            step["staged"] = await stage_vote(
+                server_state(ctx.message.server), step["definition"],
+                step["options"], "Timer: " + dashboard_time_text)
+        winner = await run_vote(ctx, step["definition"], step["options"],
+                                staged=step["staged"], ping=False,
+                                dashboard=dashboard)
+        result = step["definition"]["result"].format(**option_fields(winner))
+        dashboard.finish(session_step_label(step), result)
+        return result
+    elif "password" in step:
+        await run_password(ctx, step["password"], step["seconds"],
+                           dashboard=dashboard)
+        dashboard.finish("Password", "Released")
+    else:
+        await run_timer(ctx, "countdown", step["seconds"],
+                        dashboard=dashboard)
+        dashboard.finish("Countdown", timer_texts["countdown"][1])
+
+def abandon_session(state, stages, dashboard):
+    """
+    Forget the votes and timers of a $session which stopped part way
+    through, so none of them are finished later or after a restart.
+    """
+    for steps in stages:
+        for step in steps:
+            if step.get("staged") is not None:
+                vote_message, seeding = step["staged"]
+                seeding.cancel()
+                abandon_vote(state, vote_message)
+
+    for label, entry in dashboard.entries.items():
+        countdown = entry["countdown"]
+        if countdown is not None:
+            countdown_scheduler.remove(countdown)
+            active_store.remove(countdown.message)
+        if entry["result"] is None:
+            dashboard.finish(label, "Stopped")
+
+@bot_command(name='session', pass_context=True)
+@hoster_only()
+async def session(ctx, password=None):
+    """
+    Runs the whole pre-game sequence in session.json with one @here
+    ping: by default the region vote, then the map, perspective and
+    squad votes at once, then the password and countdown. The squad
+    result resizes the voice channels before the last stage starts.
+
+    Each stage's votes are posted stageAhead seconds before the stage
+    before it ends, so they open the moment it does. Time left and
+    leaders for everything are shown on one pinned SessionDashboard,
+    which is the session's @here announcement.
+    """
+    message_channel = ctx.message.channel
+    state = server_state(ctx.message.server)
+    session_start = time.monotonic()
+    # The version of session.json this session started with, even if it
+    # changes part way through.
+    session_definition = session_file.data
+
+    # Every step's options are worked out up front, so any mistake is
+    # reported before anything is posted.
+    stages = []
+    for stage in session_definition["stages"]:
+        steps = []
+        for step in stage:
+            if "vote" in step:
+                definition = vote_definitions[step["vote"]]
+                options, error_message = select_vote_options(
+                    step["vote"], vote_options(definition, state),
+                    step.get("args", []))
+                if error_message:
+                    await outbound.send_message(message_channel,
+                                                content=error_message)
+                    return
+                steps.append({"definition": definition, "options": options,
+                              "staged": None})
+            elif "password" in step:
+                if not password:
+                    error_message = "Error: Please enter a password."
+                    await outbound.send_message(message_channel,
+                                                content=error_message)
+                    return
+                steps.append({"password": password,
+                              "seconds": int(step["password"] * 60)})
+            else:
+                steps.append({"seconds": int(step["countdown"] * 60)})
+        stages.append(steps)
+
+    announcement = await outbound.send_message(
+        get_custom_games(state), content=session_definition["announcement"])
+    dashboard = SessionDashboard(state, announcement, len(stages))
+    for steps in stages:
+        for step in steps:
+            dashboard.add(session_step_label(step))
+    countdown_scheduler.add(dashboard)
+    try:
+        await outbound.pin_message(announcement)
+    except discord.HTTPException as error:
+        print("Couldn't pin the session dashboard:", error)
+    log_command(ctx.message, "Session")
+
+    results = []
+    staging = None
+    completed = cancelled = False
+    try:
+        for index, steps in enumerate(stages):
+            dashboard.stage = index
+            next_steps = stages[index + 1] if index + 1 < len(stages) else []
+            staging = perf.spawn(stage_session_votes(
+                state, next_steps,
+                stage_length(steps) - session_definition["stageAhead"],
+                session_definition["staged"]))
+
+            step_tasks = [perf.spawn(run_session_step(ctx, step, dashboard))
+                          for step in steps]
+            try:
+                step_results = await asyncio.gather(*step_tasks)
+            except Exception:
+                # One step failing ends the session, so stop the rest.
+                for task in step_tasks:
+                    task.cancel()
+                raise
+            results.extend(i for i in step_results if i)
+
+            # Make sure the next stage's votes are posted before opening
+            # them.
+            await staging
+        completed = True
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        if staging is not None:
+            staging.cancel()
+        if cancelled:
+            # The bot is shutting down. Whatever was saved in active_store
+            # is finished after the restart, and nothing more can be sent.
+            countdown_scheduler.remove(dashboard)
+        else:
+            if not completed:
+                abandon_session(state, stages, dashboard)
+            await dashboard.close("Finished" if completed else "Stopped")
+            try:
+                await outbound.unpin_message(announcement)
+            except discord.HTTPException as error:
+                print("Couldn't unpin the session dashboard:", error)
+
+    session_time = datetime.timedelta(
+        seconds=round(time.monotonic() - session_start))
+    summary = "Session finished in {}.\n{}".format(
+        get_countdown_string(session_time), "\n".join(results))
+    await outbound.send_message(message_channel, content=summary)
+    log_command(ctx.message, "Session result | {}s".format(
+        session_time.seconds))
+
+# What to do with each kind of active_store entry after a restart.
+resume_handlers = {"vote": resume_vote,
+                   "fullvote": resume_full_vote,
+                   "password": resume_password,
+                   "timer": resume_timer}
+
+async def resize_voice_channels(state, user_limit, concurrency=5):
+    """
+    Set every custom games voice channel on a server to user_limit,
+    with up to concurrency edits in flight at once. Channels already at
+    that limit are left alone. Returns (number of channels changed,
+    failures) where failures is a list of (channel, error).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    channels_to_edit = [channel for channel in state.voice_channels
+                        if channel.user_limit != user_limit]
 
-    while datetime.datetime.now() < time_to_post:
-        countdown_timer = time_to_post - datetime.datetime.now()
-        countdown_timer_string = get_countdown_string(countdown_timer)
-        await asyncio.sleep(1)
-        new_message = template_string.format(countdown_timer_string)
-        await discord_client.edit_message(timer_message, new_message)
+    async def resize(channel):
+        async with semaphore:
+            try:
+                await outbound.edit_channel(channel,
+                                            user_limit=user_limit)
+            except discord.HTTPException as error:
+                return channel, error
+
+    results = await asyncio.gather(*[resize(i) for i in channels_to_edit])
+    failures = [i for i in results if i is not None]
 
-    await discord_client.delete_message(timer_message)
-    await discord_client.send_message(customs_channel, content="Time's Up!")
+    return len(channels_to_edit) - len(failures), failures
 
-@discord_client.command(name='setvoicelimit', pass_context=True)
+@bot_command(name='setvoicelimit', pass_context=True)
 @hoster_only()
 async def set_voice_limit(ctx, user_limit):
     """
     Changes all custom games voice channel sizes to the one specified.
 
-    Can be run either directly via $setvoicelimit or indirectly in
-    other functions.
+    Vote results set the limit through apply_voice_limit() instead,
+    since they may be finishing after a restart with no command to
+    invoke this from.
     """
     message_channel = ctx.message.channel
 
@@ -818,23 +3358,97 @@ async def set_voice_limit(ctx, user_limit):
     except ValueError:
         error_message = ("Error: Please use an integer to denote "
                          "the size of voice channels.")  
-        await discord_client.send_message(message_channel, content=error_message)
+        await outbound.send_message(message_channel, content=error_message)
         return
 
-    all_channels = discord_client.get_all_channels()
-    for channel in all_channels:
-        server_check = channel.server == discord_client.get_server(
-            config_data["serverID"])
+    state = server_state(ctx.message.server)
+    await apply_voice_limit(state, message_channel, voice_limit_int)
 
-        if channel.name.startswith("\U0001F6E0") and server_check:
-            await discord_client.edit_channel(channel, user_limit=voice_limit_int)
+async def apply_voice_limit(state, message_channel, user_limit):
+    """Resize a server's voice channels and report back how it went."""
+    num_changed, failures = await resize_voice_channels(state, user_limit)
+    num_unchanged = len(state.voice_channels) - num_changed - len(failures)
 
-    voice_limit_message = "Set custom games voice channels to new user limit of {}."
-    voice_message = voice_limit_message.format(voice_limit_int)
+    voice_limit_message = ("Set custom games voice channels to new user limit"
+                           " of {}. ({} changed, {} already that size)")
+    voice_message = voice_limit_message.format(user_limit, num_changed,
+                                               num_unchanged)
+    for channel, error in failures:
+        voice_message += "\nFailed to resize {}: {}".format(channel.name,
+                                                            error)
 
-    await discord_client.send_message(message_channel, content=voice_message)
+    await outbound.send_message(message_channel, content=voice_message)
 
-@discord_client.command(name='clear', pass_context=True)
+async def clear_bot_messages(channel, limit=None, report_progress=None):
+    """
+    Delete the bot's most recent limit messages in channel, or all of
+    them if limit is None. Returns the number deleted. Role messages
+    and pinned messages (such as a session dashboard) are left alone.
+
+    History is paged through 100 messages at a time until enough are
+    found. Messages under 14 days old are bulk deleted in chunks of up
+    to 100 as they're found; Discord won't bulk delete anything older,
+    so those are deleted one at a time at the end. report_progress is
+    awaited with the running total after each page.
+    """
+    # A little leeway so nothing crosses the 14 day line mid-request.
+    bulk_cutoff = (datetime.datetime.utcnow()
+                   - datetime.timedelta(days=14, minutes=-5))
+    bot_id = config_file.data["botID"]
+
+    recent_messages, old_messages = [], []
+    num_found = num_removed = 0
+    before = None
+
+    async def bulk_delete(messages):
+        if len(messages) == 1:
+            await outbound.delete_message(messages[0])
+        else:
+            await outbound.delete_messages(messages)
+
+    while limit is None or num_found < limit:
+        page = []
+        async for message in discord_client.logs_from(channel, limit=100,
+                                                      before=before):
+            page.append(message)
+        if not page:
+            break
+        before = page[-1]
+
+        for message in page:
+            if message.author.id != bot_id:
+                continue
+            if message.pinned or message.id in role_messages:
+                continue
+            if message.timestamp > bulk_cutoff:
+                recent_messages.append(message)
+            else:
+                old_messages.append(message)
+            num_found += 1
+            if num_found == limit:
+                break
+
+        while len(recent_messages) >= 100:
+            await bulk_delete(recent_messages[:100])
+            recent_messages = recent_messages[100:]
+            num_removed += 100
+
+        if report_progress is not None:
+            await report_progress(num_removed)
+
+    if recent_messages:
+        await bulk_delete(recent_messages)
+        num_removed += len(recent_messages)
+
+    for message in old_messages:
+        await outbound.delete_message(message)
+        num_removed += 1
+        if report_progress is not None and num_removed % 10 == 0:
+            await report_progress(num_removed)
+
+    return num_removed
+
+@bot_command(name='clear', pass_context=True)
 @hoster_only()
 async def remove_messages(ctx, num_messages):
     """
@@ -842,75 +3456,455 @@ async def remove_messages(ctx, num_messages):
 
     Hosters aren't necessarily mods, so they need some way to clear
     CustomsBot's messages. This function removes either a set amount
-    or all of CustomsBot's messages.
+    or all of CustomsBot's messages, reporting progress as it goes.
     """
     message_channel = ctx.message.channel
 
-    if num_messages != 'all':
+    if num_messages == 'all':
+        limit = None
+    else:
         try:
-            num_messages = int(num_messages)
+            limit = int(num_messages)
         except ValueError:
             error_message = ("Error: Please use an integer to denote the"
                              " number of messages to clear.")
-            await discord_client.send_message(message_channel,
-                                              content=error_message)
+            await outbound.send_message(message_channel,
+                                        content=error_message)
             return
-    
-    customs_channel = get_custom_games()
 
-    message_count = 0
-    messages_to_remove = []
+    state = server_state(ctx.message.server)
+    customs_channel = get_custom_games(state)
 
-    bot_id = config_data["botID"]
+    progress_text = "Removing CustomsBot messages from #custom-games... {}"
+    progress_message = await outbound.send_message(message_channel,
+                                                   progress_text.format(0))
 
-    # Defaults to only retrieving 100 messages from #custom-games.
-    # Has the potential to cause an issue, but should rarely ever do so.
-    async for message in discord_client.logs_from(customs_channel):
-        if message.author.id == bot_id:
-            if num_messages == 'all':
-                messages_to_remove.append(message)
-            else:
-                messages_to_remove.append(message)
-                message_count += 1
-                if message_count == num_messages:
-                    break
+    last_reported = 0
 
-    for customsbot_message in messages_to_remove:
-        await discord_client.delete_message(customsbot_message)
+    async def report_progress(num_removed):
+        nonlocal last_reported
+        if num_removed == last_reported:
+            return
+        last_reported = num_removed
+        await outbound.edit_message(progress_message,
+                                    progress_text.format(num_removed),
+                                    priority=COSMETIC)
+
+    num_removed = await clear_bot_messages(customs_channel, limit,
+                                           report_progress)
 
     confirmation_text = "Removed {} CustomsBot messages from #custom-games."
-    confirmation_text = confirmation_text.format(num_messages)
-    await discord_client.send_message(message_channel, confirmation_text)
+    confirmation_text = confirmation_text.format(num_removed)
+    await outbound.edit_message(progress_message, confirmation_text)
+
+    log_command(ctx.message, "Remove messages | {}".format(num_messages))
+
+def command_stats(days):
+    """
+    Summarise the last days days of the command log database. Each
+    query is answered from an index on (command, time) or (dm, time).
+    Blocking, so should be run in an executor.
+    """
+    since = (datetime.datetime.utcnow()
+             - datetime.timedelta(days=days)).isoformat()
+    vote_commands = [i["log"].lower() for i in vote_definitions.values()]
+    vote_commands.append("full vote")
+    result_commands = [i + " result" for i in vote_commands[:-1]]
+
+    def placeholders(values):
+        return ", ".join("?" * len(values))
+
+    db = open_log_db()
+    try:
+        votes_per_day = db.execute(
+            "SELECT substr(time, 1, 10), COUNT(*) FROM commands"
+            " WHERE command IN ({}) AND time >= ?"
+            " GROUP BY 1 ORDER BY 1".format(placeholders(vote_commands)),
+            vote_commands + [since]).fetchall()
+
+        top_dm_commands = db.execute(
+            "SELECT command, COUNT(*) FROM commands"
+            " WHERE dm = 1 AND time >= ?"
+            " GROUP BY command ORDER BY 2 DESC LIMIT 5", (since,)).fetchall()
+
+        role_grants = db.execute(
+            "SELECT COUNT(*) FROM commands"
+            " WHERE command = 'role' AND time >= ?"
+            " AND detail LIKE '%granted new role'", (since,)).fetchone()[0]
+
+        vote_results = db.execute(
+            "SELECT command, result, COUNT(*) FROM commands"
+            " WHERE command IN ({}) AND time >= ?"
+            " GROUP BY command, result"
+            " ORDER BY command, 3 DESC".format(placeholders(result_commands)),
+            result_commands + [since]).fetchall()
+    finally:
+        db.close()
+
+    return votes_per_day, top_dm_commands, role_grants, vote_results
+
+@bot_command(name='stats', pass_context=True)
+@hoster_only()
+async def stats(ctx, days="7"):
+    """
+    Posts a summary of the command log for the last 7 days, or however
+    many days are given: votes per day, the most used DM commands, how
+    many people were given the custom role, and how often each option
+    has won each vote type.
+    """
+    message_channel = ctx.message.channel
+
+    try:
+        days = int(days)
+    except ValueError:
+        error_message = ("Error: Please use an integer to denote the "
+                         "number of days for `stats`.")
+        await outbound.send_message(message_channel,
+                                    content=error_message)
+        return
+
+    votes_per_day, top_dm_commands, role_grants, vote_results = (
+        await discord_client.loop.run_in_executor(None, command_stats, days))
+
+    stats_embed = discord.Embed(
+        title="CustomsBot stats for the last {} days".format(days))
+
+    votes_text = "\n".join("{}: {}".format(*i) for i in votes_per_day)
+    stats_embed.add_field(name="Votes per day", value=votes_text or "None",
+                          inline=False)
+
+    dm_text = "\n".join("{}: {}".format(*i) for i in top_dm_commands)
+    stats_embed.add_field(name="Top DM commands", value=dm_text or "None",
+                          inline=False)
+
+    stats_embed.add_field(name="Role grants", value=str(role_grants),
+                          inline=False)
+
+    vote_totals = {}
+    for command, _, count in vote_results:
+        vote_totals[command] = vote_totals.get(command, 0) + count
+
+    result_lines = OrderedDict()
+    for command, result, count in vote_results:
+        result_lines.setdefault(command, []).append("{} {:.0%}".format(
+            result, count / vote_totals[command]))
+
+    for command, lines in result_lines.items():
+        stats_embed.add_field(name=command.capitalize(),
+                              value=", ".join(lines), inline=False)
 
-    log_command(ctx.message, "Remove messages ({})".format(num_messages))
+    await outbound.send_message(message_channel, embed=stats_embed)
 
-@discord_client.command(name='help', pass_context=True)
+def vote_trends(vote, server_id, days):
+    """
+    Summarise the saved results of one vote type (or full vote setting)
+    on a server over the last days days. Everything is aggregated by
+    SQLite in a handful of grouped queries over the vote_results index,
+    rather than row by row in Python. Blocking, so should be run in an
+    executor.
+    """
+    since = (datetime.datetime.utcnow()
+             - datetime.timedelta(days=days)).isoformat()
+    where = " WHERE r.vote = ? AND r.server_id = ? AND r.time >= ?"
+    parameters = (vote, server_id, since)
+
+    db = open_log_db()
+    try:
+        num_votes, avg_turnout, num_ties = db.execute(
+            "SELECT COUNT(*), AVG(r.turnout), SUM(r.tied > 1)"
+            " FROM vote_results r" + where, parameters).fetchone()
+
+        option_totals = db.execute(
+            "SELECT c.option, SUM(c.votes) FROM vote_results r"
+            " JOIN vote_counts c ON c.message_id = r.message_id" + where +
+            " GROUP BY c.option ORDER BY 2 DESC", parameters).fetchall()
+
+        # Winners per six hour block of the day, UTC.
+        winners_by_time = db.execute(
+            "SELECT CAST(substr(r.time, 12, 2) AS INTEGER) / 6, r.winner,"
+            " COUNT(*) FROM vote_results r" + where +
+            " GROUP BY 1, 2 ORDER BY 1, 3 DESC", parameters).fetchall()
+    finally:
+        db.close()
+
+    return num_votes, avg_turnout, num_ties, option_totals, winners_by_time
+
+def trend_vote_name(name):
+    """
+    The name a vote's results are saved under, from a vote command,
+    one of its aliases or a full vote setting. None if there isn't one.
+    """
+    name = name.lower()
+    for vote_name, definition in vote_definitions.items():
+        if name == vote_name or name in definition.get("aliases", []):
+            return vote_name
+    for setting_name in fullvote_settings:
+        if name == setting_name.lower():
+            return setting_name
+    return None
+
+@bot_command(name='trends', pass_context=True)
+@hoster_only()
+async def trends(ctx, vote, days="30"):
+    """
+    Posts how a vote has gone on this server over the last 30 days, or
+    however many days are given: how many times it was run, turnout
+    and ties, each option's share of all votes, and which options won
+    at each time of day. Full vote settings can be given by name, in
+    quotes.
+    """
+    message_channel = ctx.message.channel
+    state = server_state(ctx.message.server)
+
+    vote_name = trend_vote_name(vote)
+    if vote_name is None:
+        error_message = ("Error: `{}` isn't a vote command or full vote "
+                         "setting.".format(vote))
+        await outbound.send_message(message_channel, content=error_message)
+        return
+
+    try:
+        days = int(days)
+    except ValueError:
+        error_message = ("Error: Please use an integer to denote the "
+                         "number of days for `trends`.")
+        await outbound.send_message(message_channel, content=error_message)
+        return
+
+    num_votes, avg_turnout, num_ties, option_totals, winners_by_time = (
+        await discord_client.loop.run_in_executor(
+            None, vote_trends, vote_name, state.id, days))
+
+    if num_votes == 0:
+        no_results = "No {} results in the last {} days.".format(vote_name,
+                                                                 days)
+        await outbound.send_message(message_channel, content=no_results)
+        return
+
+    def option_label(key):
+        # Region options are custom emoji IDs.
+        return str(resolve_emoji(key) or key)
+
+    trends_embed = discord.Embed(
+        title="{} trends for the last {} days".format(vote_name, days))
+
+    summary_text = "{} votes, average turnout {:.1f}, {} tied".format(
+        num_votes, avg_turnout, num_ties)
+    trends_embed.add_field(name="Votes", value=summary_text, inline=False)
+
+    all_votes = sum(count for _, count in option_totals)
+    share_text = "No votes cast"
+    if all_votes:
+        share_text = ", ".join("{} {:.0%}".format(option_label(option),
+                                                  count / all_votes)
+                               for option, count in option_totals)
+    trends_embed.add_field(name="Share of votes", value=share_text,
+                           inline=False)
+
+    time_lines = OrderedDict()
+    for block, winner, count in winners_by_time:
+        time_lines.setdefault(block, []).append(
+            "{} {}".format(option_label(winner), count))
+    time_text = "\n".join("{:02d}:00-{:02d}:00: {}".format(
+        block * 6, block * 6 + 6, ", ".join(winners))
+        for block, winners in time_lines.items())
+    trends_embed.add_field(name="Winners by time of day (UTC)",
+                           value=time_text, inline=False)
+
+    await outbound.send_message(message_channel, embed=trends_embed)
+    log_command(ctx.message, "Trends | {}".format(vote_name))
+
+@bot_command(name='help', pass_context=True)
 @hoster_only()
 async def help(ctx):
     hoster_channel = ctx.message.channel
 
-    help_text = "\n\n".join(text_data["helpText"])
+    help_embed = bot_text.rendered("help_embed", render_help_embed)
 
-    help_embed = discord.Embed(title="CustomsBot available commands",
-                               description=help_text)
+    await outbound.send_message(hoster_channel, embed=help_embed)
 
-    await discord_client.send_message(hoster_channel, embed=help_embed)
+def render_help_embed(text):
+    help_text = "\n\n".join(text["helpText"])
+    return discord.Embed(title="CustomsBot available commands",
+                         description=help_text)
 
-@discord_client.command(name='schedule', pass_context=True)
+@bot_command(name='reload', pass_context=True)
+@hoster_only()
+async def reload(ctx):
+    """
+    Reloads bot_text.json, config.json and session.json without
+    restarting, so running votes and timers carry on. A file with a
+    mistake in it is left on its previous version, and the error is
+    reported back.
+    """
+    message_channel = ctx.message.channel
+
+    errors = [i for i in (bot_text.reload(), config_file.reload(),
+                          session_file.reload()) if i]
+    if errors:
+        reload_text = "Kept the previous version of:\n" + "\n".join(errors)
+    else:
+        reload_text = "Reloaded bot_text.json, config.json and session.json."
+
+    await outbound.send_message(message_channel, content=reload_text)
+    log_command(ctx.message, "Reload",
+                result="kept previous" if errors else "reloaded")
+
+def format_seconds(seconds):
+    """Short text for a duration, or - if there's nothing to show."""
+    if seconds is None:
+        return "-"
+    if abs(seconds) < 1:
+        return "{:.0f}ms".format(seconds * 1000)
+    return "{:.1f}s".format(seconds)
+
+@bot_command(name='perf', pass_context=True)
+@hoster_only()
+async def perf_report(ctx):
+    """
+    Posts what the bot has been spending its time on: event loop lag,
+    how long the most used commands take and the REST calls they make,
+    how late countdowns have finished and how much is queued up.
+    """
+    message_channel = ctx.message.channel
+
+    perf_embed = discord.Embed(title="CustomsBot performance")
+
+    lag = list(perf.lag)
+    lag_text = "Last {}, median {}, p99 {}, max {}".format(
+        format_seconds(lag[-1] if lag else None),
+        format_seconds(percentile(lag, 0.5)),
+        format_seconds(percentile(lag, 0.99)), format_seconds(perf.max_lag))
+    perf_embed.add_field(name="Event loop lag", value=lag_text, inline=False)
+
+    busiest = sorted(perf.commands.items(), key=lambda i: -i[1]["count"])
+    command_lines = []
+    for name, stats in busiest[:10]:
+        command_lines.append(
+            "`{}` x{}: parse {}, first response {}, done {} (medians), "
+            "{:.1f} REST calls each, {} 429s".format(
+                name, stats["count"],
+                format_seconds(percentile(stats["parse"], 0.5)),
+                format_seconds(percentile(stats["first_response"], 0.5)),
+                format_seconds(percentile(stats["completion"], 0.5)),
+                stats["rest_calls"] / stats["count"], stats["rate_limited"]))
+    perf_embed.add_field(name="Commands",
+                         value="\n".join(command_lines) or "None",
+                         inline=False)
+
+    rest_text = "{} calls, {} rate limited".format(perf.rest_calls,
+                                                   perf.rate_limited)
+    perf_embed.add_field(name="REST", value=rest_text, inline=False)
+
+    drift_text = "\n".join(
+        "{}: median {}, worst {}".format(kind,
+                                         format_seconds(percentile(drift, 0.5)),
+                                         format_seconds(max(drift)))
+        for kind, drift in sorted(perf.drift.items()))
+    perf_embed.add_field(name="Countdown results after deadline",
+                         value=drift_text or "None", inline=False)
+
+    dm_stats = dm_pipeline.stats()
+    dm_text = ("{handled} answered, {coalesced} merged into another, "
+               "{rate_limited} rate limited, {dropped} dropped, {failed} "
+               "failed. Median reply {median}, worst {worst}").format(
+                   median=format_seconds(percentile(dm_pipeline.latencies,
+                                                    0.5)),
+                   worst=format_seconds(max(dm_pipeline.latencies,
+                                            default=None)),
+                   **dm_stats)
+    perf_embed.add_field(name="DMs", value=dm_text, inline=False)
+
+    queue_text = ", ".join("{} {}".format(name, depth)
+                           for name, depth in perf.queue_depths().items())
+    perf_embed.add_field(name="Queued", value=queue_text, inline=False)
+
+    outbound_stats = outbound.stats()
+    wait_text = "\n".join(
+        "{}: average {}, worst {}".format(
+            name, format_seconds(outbound_stats[name + "_avg_wait"]),
+            format_seconds(outbound_stats[name + "_max_wait"]))
+        for name in priority_names.values())
+    wait_text += "\n{} edits merged into a newer one".format(
+        outbound_stats["coalesced"])
+    perf_embed.add_field(name="Outbound queue waits", value=wait_text,
+                         inline=False)
+
+    role_lines = []
+    for state in server_states.values():
+        role_stats = state.role_queue.stats()
+        role_lines.append(
+            "{}: {} applied, {} failed, average {}, worst {}".format(
+                state.server.name if state.server else state.id,
+                role_stats["applied"], role_stats["failed"],
+                format_seconds(role_stats["avg_latency"]),
+                format_seconds(role_stats["max_latency"])))
+    perf_embed.add_field(name="Role changes",
+                         value="\n".join(role_lines) or "None", inline=False)
+
+    await outbound.send_message(message_channel, embed=perf_embed)
+
+@bot_command(name='schedule', pass_context=True)
 async def schedule(ctx):
-    schedule_text = text_data["chatResponses"]["schedule"]
+    schedule_text = bot_text.data["chatResponses"]["schedule"]
     message_channel = ctx.message.channel
-    await discord_client.send_message(message_channel, content=schedule_text)
-    await discord_client.delete_message(ctx.message)
+    await outbound.send_message(message_channel, content=schedule_text)
+    await outbound.delete_message(ctx.message)
     log_command(ctx.message, "Schedule info posted")
 
-@discord_client.event
+@bot_command(name='twitch', pass_context=True)
+async def twitch(ctx):
+    twitch_info = twitch_text(bot_text.data["chatResponses"]["twitch"])
+    message_channel = ctx.message.channel
+    await outbound.send_message(message_channel, content=twitch_info)
+    await outbound.delete_message(ctx.message)
+    log_command(ctx.message, "Twitch info posted")
+
+@bot_event
 async def on_command_error(error, ctx):
     if isinstance(error, commands.MissingRequiredArgument):
         message_channel = ctx.message.channel
-        await discord_client.send_message(message_channel,
-                                  content= 'Required argument(s) missing.')
+        await outbound.send_message(message_channel,
+                                    content='Required argument(s) missing.')
     else:
         print(error)
 
-discord_client.run(config_data["botToken"])
+def create_bot(client=None, twitch=None, config=None):
+    """
+    Attach the bot's events and commands to a Discord client and make it
+    the one everything uses. By default that's a real client configured
+    from config.json, with a real Twitch client, but any stand-ins can
+    be passed in (see fake_discord.py). config is a JSONFile to use in
+    place of config.json.
+    """
+    global discord_client, twitch_client, config_file
+
+    if config is not None:
+        config_file = config
+
+    if client is None:
+        # A bot with many servers can be split over several processes,
+        # each given a shardID out of shardCount, and only sees its
+        # share of them.
+        client = commands.Bot(command_prefix='$',
+                              shard_id=config_file.data.get("shardID"),
+                              shard_count=config_file.data.get("shardCount"))
+    if twitch is None:
+        twitch = TwitchClient(client_id=config_file.data["twitchClientID"])
+
+    discord_client = client
+    twitch_client = twitch
+
+    # Stop inbuilt $help overriding ours.
+    client.remove_command('help')
+    for event in bot_events:
+        client.event(event)
+    for command in bot_commands:
+        client.add_command(command)
+    build_command_table(client)
+
+    apply_server_configs(config_file.data)
+    return client
+
+if __name__ == "__main__":
+    create_bot().run(config_file.data["botToken"])
@@ -0,0 +1,514 @@
+"""
+An in-process stand-in for Discord and Twitch, so CustomsBot can be run
+and measured without a connection.
+
+FakeDiscord is a commands.Bot whose REST methods act on fake servers,
+channels and messages held in memory instead of calling Discord. Every
+call is recorded with its route and timing, takes a configurable
+latency, and is held to rate limits roughly matching Discord's. Going
+over a limit counts as a 429; like discord.py the call then logs it,
+waits for the limit to reset and goes through, unless raise_429 is set, in which
+case it fails with an HTTPException as a real 429 would without
+discord.py's retries. Gateway events (messages, reactions, background
+noise) are fed in through the bot's normal event handlers, and can be
+recorded and replayed.
+
+See bench.py for how it's used with create_bot().
+"""
+
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import random
+import time
+from collections import Counter, deque
+
+import discord
+from discord.ext import commands
+
+log = logging.getLogger("discord.http")
+
+snowflakes = itertools.count(400000000000000000)
+
+def snowflake():
+    return str(next(snowflakes))
+
+class FakeResponse:
+    """Enough of an aiohttp response for discord.HTTPException."""
+
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+class FakeUser:
+
+    def __init__(self, name, id=None, bot=False):
+        self.id = id or snowflake()
+        self.name = name
+        self.discriminator = "0001"
+        self.bot = bot
+        self.mention = "<@{}>".format(self.id)
+
+    def __str__(self):
+        return "{}#{}".format(self.name, self.discriminator)
+
+class FakeMember(FakeUser):
+
+    def __init__(self, server, name, id=None, roles=(), bot=False):
+        super().__init__(name, id, bot)
+        self.server = server
+        self.roles = list(roles)
+
+class FakeRole:
+
+    def __init__(self, name, id=None):
+        self.id = id or snowflake()
+        self.name = name
+
+class FakeEmoji:
+
+    def __init__(self, server, name, id=None):
+        self.id = id or snowflake()
+        self.name = name
+        self.server = server
+
+    def __str__(self):
+        return "<:{}:{}>".format(self.name, self.id)
+
+class FakeChannel:
+
+    def __init__(self, server, name, id=None, user_limit=0, voice=False):
+        self.id = id or snowflake()
+        self.name = name
+        self.server = server
+        self.user_limit = user_limit
+        self.type = "voice" if voice else "text"
+        self.is_private = False
+        self.history = []  # Oldest first.
+
+class FakePrivateChannel:
+
+    def __init__(self, user):
+        self.id = snowflake()
+        self.user = user
+        self.server = None
+        self.is_private = True
+        self.history = []
+
+class FakeReaction:
+
+    def __init__(self, emoji):
+        self.emoji = emoji
+        self.count = 0
+        self.me = False
+        self.users = set()
+
+class FakeMessage:
+
+    def __init__(self, channel, author, content=None, embed=None):
+        self.id = snowflake()
+        self.channel = channel
+        self.server = channel.server
+        self.author = author
+        self.content = content or ""
+        self.embeds = [embed.to_dict()] if embed else []
+        self.reactions = []
+        self.timestamp = datetime.datetime.utcnow()
+        self.pinned = False
+        self.deleted = False
+
+    def reaction(self, emoji):
+        for reaction in self.reactions:
+            if str(reaction.emoji) == str(emoji):
+                return reaction
+        reaction = FakeReaction(emoji)
+        self.reactions.append(reaction)
+        return reaction
+
+class FakeServer:
+
+    def __init__(self, name, id=None):
+        self.id = id or snowflake()
+        self.name = name
+        self.roles = []
+        self.channels = []
+        self.members = []
+        self.emojis = []
+
+    def get_member(self, user_id):
+        for member in self.members:
+            if member.id == user_id:
+                return member
+        return None
+
+    def get_channel(self, channel_id):
+        for channel in self.channels:
+            if channel.id == channel_id:
+                return channel
+        return None
+
+class FakeHistory:
+    """Async iterator over a channel's history, newest first, as logs_from()."""
+
+    def __init__(self, client, channel, limit, before):
+        self.client = client
+        self.channel = channel
+        self.limit = limit
+        self.before = before
+        self.messages = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.messages is None:
+            await self.client.request("logs_from", self.channel.id)
+            messages = [i for i in reversed(self.channel.history)
+                        if not i.deleted]
+            if self.before is not None:
+                messages = [i for i in messages if int(i.id) < int(self.before.id)]
+            self.messages = deque(messages[:self.limit])
+        if not self.messages:
+            raise StopAsyncIteration
+        return self.messages.popleft()
+
+# Discord's limits per route: (requests, per seconds). These are close to
+# what Discord reported in its rate limit headers for bots at the time.
+default_rate_limits = {
+    "send_message": (5, 5),
+    "edit_message": (5, 5),
+    "delete_message": (5, 1),
+    "delete_messages": (1, 1),
+    "add_reaction": (1, 0.25),
+    "clear_reactions": (1, 0.25),
+    "edit_channel": (10, 10),
+    "roles": (10, 10),
+    "get_message": (5, 1),
+    "logs_from": (5, 5),
+    "change_presence": (5, 60),
+}
+
+class FakeDiscord(commands.Bot):
+    """
+    A Bot with no connection to Discord. See the module docstring.
+
+    latency is how long each REST call takes in seconds, plus up to
+    jitter more at random. Set rate_limits to None to turn them off.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, rate_limits=default_rate_limits,
+                 raise_429=False, loop=None, **options):
+        super().__init__(command_prefix='$', loop=loop, **options)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limits = rate_limits
+        self.raise_429 = raise_429
+        self.fake_user = FakeUser("CustomsBot", bot=True)
+        self.fake_servers = []
+        self.calls = []  # (method, bucket, started, finished)
+        self.rate_limited = Counter()
+        self.buckets = {}
+        self.waiters = []
+        self.dm_channels = {}
+        self.recording = None  # Set to a list to record gateway frames.
+        self.random = random.Random(0)
+
+    @property
+    def user(self):
+        return self.fake_user
+
+    @property
+    def servers(self):
+        return list(self.fake_servers)
+
+    def get_server(self, id):
+        for server in self.fake_servers:
+            if server.id == id:
+                return server
+        return None
+
+    def get_channel(self, id):
+        for server in self.fake_servers:
+            channel = server.get_channel(id)
+            if channel is not None:
+                return channel
+        return None
+
+    def run(self, *args, **kwargs):
+        raise RuntimeError("FakeDiscord doesn't connect; drive it from an "
+                           "event loop instead.")
+
+    # REST
+
+    async def request(self, method, bucket_id):
+        """Wait out the rate limit and latency for one call, and record it."""
+        started = time.monotonic()
+        bucket = ("roles" if method in ("add_roles", "remove_roles")
+                  else method, bucket_id)
+
+        limit = (self.rate_limits or {}).get(bucket[0])
+        if limit is not None:
+            requests, per = limit
+            history = self.buckets.setdefault(bucket, deque())
+            while True:
+                now = time.monotonic()
+                while history and now - history[0] >= per:
+                    history.popleft()
+                if len(history) < requests:
+                    history.append(now)
+                    break
+                self.rate_limited[method] += 1
+                retry_after = per - (now - history[0])
+                if self.raise_429:
+                    raise discord.HTTPException(
+                        FakeResponse(429, "Too Many Requests"),
+                        {"message": "You are being rate limited.",
+                         "retry_after": int(retry_after * 1000)})
+                # Logged the way discord.py logs its own retries.
+                log.info('We are being rate limited. Retrying in {:.2} '
+                         'seconds. Handled under the bucket "{}"'.format(
+                             retry_after, bucket))
+                await asyncio.sleep(retry_after)
+
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        call = (method, bucket_id, started, time.monotonic())
+        self.calls.append(call)
+        for waiter in list(self.waiters):
+            predicate, future = waiter
+            if not future.done() and predicate(call):
+                future.set_result(call)
+                self.waiters.remove(waiter)
+
+    def wait_for_call(self, method, bucket_id=None, timeout=None):
+        """Wait for the next call of method (to bucket_id, if given)."""
+        def predicate(call):
+            return call[0] == method and (bucket_id is None
+                                          or call[1] == bucket_id)
+        future = self.loop.create_future()
+        self.waiters.append((predicate, future))
+        return asyncio.wait_for(future, timeout)
+
+    def call_counts(self, since=0):
+        """{method: number of calls} for calls started after since."""
+        return Counter(i[0] for i in self.calls if i[2] >= since)
+
+    async def send_message(self, destination, content=None, *, tts=False,
+                           embed=None):
+        if isinstance(destination, FakeUser):
+            destination = self.private_channel(destination)
+        await self.request("send_message", destination.id)
+        message = FakeMessage(destination, self.user, content, embed)
+        destination.history.append(message)
+        return message
+
+    async def edit_message(self, message, new_content=None, *, embed=None):
+        await self.request("edit_message", message.channel.id)
+        self.check_exists(message)
+        message.content = new_content or ""
+        if embed is not None:
+            message.embeds = [embed.to_dict()]
+        return message
+
+    async def delete_message(self, message):
+        await self.request("delete_message", message.channel.id)
+        self.check_exists(message)
+        message.deleted = True
+
+    async def delete_messages(self, messages):
+        if not 2 <= len(messages) <= 100:
+            raise discord.ClientException(
+                "Can only bulk delete messages up to 100 messages")
+        await self.request("delete_messages", messages[0].channel.id)
+        for message in messages:
+            message.deleted = True
+
+    async def add_reaction(self, message, emoji):
+        await self.request("add_reaction", message.channel.id)
+        self.check_exists(message)
+        reaction = message.reaction(emoji)
+        if not reaction.me:
+            reaction.me = True
+            reaction.count += 1
+
+    async def clear_reactions(self, message):
+        await self.request("clear_reactions", message.channel.id)
+        message.reactions = []
+
+    async def get_message(self, channel, id):
+        await self.request("get_message", channel.id)
+        for message in channel.history:
+            if message.id == id and not message.deleted:
+                return message
+        raise discord.NotFound(FakeResponse(404, "Not Found"),
+                               {"message": "Unknown Message"})
+
+    def logs_from(self, channel, limit=100, *, before=None, after=None):
+        return FakeHistory(self, channel, limit, before)
+
+    async def edit_channel(self, channel, **options):
+        await self.request("edit_channel", channel.id)
+        for name, value in options.items():
+            setattr(channel, name, value)
+
+    async def add_roles(self, member, *roles):
+        await self.request("add_roles", member.server.id)
+        member.roles.extend(i for i in roles if i not in member.roles)
+
+    async def remove_roles(self, member, *roles):
+        await self.request("remove_roles", member.server.id)
+        member.roles = [i for i in member.roles if i not in roles]
+
+    async def pin_message(self, message):
+        await self.request("pin_message", message.channel.id)
+        self.check_exists(message)
+        message.pinned = True
+
+    async def unpin_message(self, message):
+        await self.request("unpin_message", message.channel.id)
+        self.check_exists(message)
+        message.pinned = False
+
+    async def change_presence(self, *, game=None, status=None, afk=False):
+        await self.request("change_presence", None)
+        self.game = game
+
+    def check_exists(self, message):
+        if message.deleted:
+            raise discord.NotFound(FakeResponse(404, "Not Found"),
+                                   {"message": "Unknown Message"})
+
+    def private_channel(self, user):
+        if user.id not in self.dm_channels:
+            self.dm_channels[user.id] = FakePrivateChannel(user)
+        return self.dm_channels[user.id]
+
+    # Gateway
+
+    def gateway(self, event_type, data):
+        """Send a raw gateway dispatch frame to on_socket_raw_receive."""
+        raw = json.dumps({"op": 0, "s": None, "t": event_type, "d": data})
+        if self.recording is not None:
+            self.recording.append(raw)
+        self.dispatch("socket_raw_receive", raw)
+
+    def replay(self, frames):
+        """Feed recorded raw frames back through the gateway."""
+        for raw in frames:
+            self.dispatch("socket_raw_receive", raw)
+
+    def say(self, channel, author, content):
+        """Have someone send a message, as the gateway would deliver it."""
+        if isinstance(channel, FakeUser):
+            channel = self.private_channel(channel)
+        message = FakeMessage(channel, author, content)
+        channel.history.append(message)
+        self.gateway("MESSAGE_CREATE", {"id": message.id,
+                                        "channel_id": channel.id,
+                                        "content": content})
+        self.dispatch("message", message)
+        return message
+
+    def react(self, message, emoji, user, add=True):
+        """Have someone add or remove a reaction."""
+        reaction = message.reaction(emoji)
+        if add and user.id not in reaction.users:
+            reaction.users.add(user.id)
+            reaction.count += 1
+        elif not add and user.id in reaction.users:
+            reaction.users.discard(user.id)
+            reaction.count -= 1
+
+        if isinstance(emoji, str):
+            emoji_data = {"id": None, "name": emoji}
+        else:
+            emoji_data = {"id": emoji.id, "name": emoji.name}
+        self.gateway("MESSAGE_REACTION_ADD" if add
+                     else "MESSAGE_REACTION_REMOVE",
+                     {"user_id": user.id, "message_id": message.id,
+                      "channel_id": message.channel.id, "emoji": emoji_data})
+
+    def noise(self, server, count=1):
+        """Gateway traffic the bot doesn't care about: presences and typing."""
+        for _ in range(count):
+            member = self.random.choice(server.members)
+            self.gateway("PRESENCE_UPDATE",
+                         {"user": {"id": member.id}, "guild_id": server.id,
+                          "status": "online", "game": None, "roles": []})
+            self.gateway("TYPING_START",
+                         {"user_id": member.id,
+                          "channel_id": server.channels[0].id,
+                          "timestamp": int(time.time())})
+
+class FakeStreams:
+
+    def __init__(self, twitch):
+        self.twitch = twitch
+
+    def get_stream_by_user(self, user_id):
+        # Called in an executor, like the real blocking client.
+        time.sleep(self.twitch.latency)
+        self.twitch.requests += 1
+        if self.twitch.live:
+            return {"channel": {"_id": user_id}, "stream_type": "live"}
+        return None
+
+class FakeTwitch:
+    """Stand-in for twitch.TwitchClient; live sets whether we're streaming."""
+
+    def __init__(self, live=False, latency=0.05):
+        self.live = live
+        self.latency = latency
+        self.requests = 0
+        self.streams = FakeStreams(self)
+
+def build_server(client, num_members=100, num_voice_channels=4,
+                 name="PUBG Reddit"):
+    """
+    A fake server set up like /r/PUBATTLEGROUNDS, added to client, along
+    with the config.json server settings that match it.
+    """
+    server = FakeServer(name)
+    custom_role = FakeRole("Custom games")
+    server.roles.append(custom_role)
+
+    channels = {key: FakeChannel(server, channel_name) for key, channel_name
+                in (("hoster", "custom-hosters"),
+                    ("customgames", "custom-games"),
+                    ("sssc", "super-secret-sub-club"))}
+    server.channels.extend(channels.values())
+    server.channels.extend(
+        FakeChannel(server, "\U0001F6E0 Customs {}".format(i + 1),
+                    user_limit=4, voice=True)
+        for i in range(num_voice_channels))
+
+    server.members.extend(FakeMember(server, "member{}".format(i))
+                          for i in range(num_members))
+    server.members.append(FakeMember(server, client.user.name,
+                                     id=client.user.id, bot=True))
+
+    emoji_names = ("Yes", "No", "Minus_one", "Minus_point_five", "Zero_five",
+                   "One_five")
+    emojis = {i: FakeEmoji(server, i) for i in emoji_names}
+    region_emojis = [FakeEmoji(server, i) for i in ("NA", "EU", "AS")]
+    server.emojis.extend(list(emojis.values()) + region_emojis)
+
+    role_message = FakeMessage(channels["customgames"], client.user,
+                               "React to get the Custom games role")
+    channels["customgames"].history.append(role_message)
+
+    client.fake_servers.append(server)
+
+    server_config = {
+        "serverID": server.id,
+        "customRoleID": custom_role.id,
+        "channels": {key: channel.id for key, channel in channels.items()},
+        "emojis": {key: emoji.id for key, emoji in emojis.items()},
+        "regionEmojis": [i.id for i in region_emojis],
+        "reactionMessageID": role_message.id,
+    }
+    return server, server_config
@@ -0,0 +1,99 @@
+"""
+Smoke tests for CustomsBot, run against the in-process Discord stand-in
+in fake_discord.py like bench.py is.
+
+    python -m pytest test_customsbot.py
+"""
+
+import argparse
+import asyncio
+import datetime
+
+import pytest
+
+# bench points the logs somewhere disposable before importing customsbot.
+import bench
+import customsbot
+
+@pytest.fixture(scope="module")
+def bot():
+    args = argparse.Namespace(latency=0.01, members=10)
+    client, server, server_config = bench.build(args)
+    client.dispatch("ready")
+    client.loop.run_until_complete(asyncio.sleep(0.2))
+    return client, server, server_config
+
+def run(client, coro, timeout=60):
+    return client.loop.run_until_complete(asyncio.wait_for(coro, timeout))
+
+def test_vote_result(bot):
+    client, server, _ = bot
+    definition = customsbot.vote_definitions["squadvote"]
+    duration = definition.get("duration")
+
+    run(client, bench.bench_vote(client, server, duration=2, voters=5))
+
+    customs = bench.channel_named(server, "custom-games")
+    result = next(i for i in customs.history
+                  if i.content.startswith("Squad size vote over"))
+    assert "(5 voters)" in result.content
+    assert not customsbot.reaction_tally.is_watched(result.id)
+    assert not customsbot.countdown_scheduler.countdowns
+    assert definition.get("duration") == duration
+
+def test_role_flood(bot):
+    client, server, server_config = bot
+    state = customsbot.server_states[server.id]
+
+    run(client, bench.bench_role_flood(client, server, server_config,
+                                       members=10, noise=5))
+
+    assert state.role_queue.stats()["failed"] == 0
+    assert state.role_queue.stats()["depth"] == 0
+    assert state.role_members >= {i.id for i in server.members[:10]}
+
+def test_clear_keeps_role_message(bot):
+    client, server, server_config = bot
+    hosters = bench.channel_named(server, "custom-hosters")
+    customs = bench.channel_named(server, "custom-games")
+
+    async def clear():
+        message = await client.send_message(customs, "Old announcement")
+        client.say(hosters, server.members[0], "$clear all")
+        await bench.wait_until(lambda: message.deleted, 10)
+
+    run(client, clear())
+
+    role_message = next(i for i in customs.history
+                        if i.id == server_config["reactionMessageID"])
+    assert not role_message.deleted
+
+def test_resume_vote(bot, tmpdir):
+    client, server, _ = bot
+    state = customsbot.server_states[server.id]
+    customs = bench.channel_named(server, "custom-games")
+    definition = customsbot.vote_definitions["squadvote"]
+    options = [i for i in definition["options"] if i["default"]]
+    store = customsbot.ActiveStore(str(tmpdir.join("active.sqlite")))
+
+    async def restart():
+        # A vote which closed while the bot was down, with three votes
+        # for the first option.
+        message = await client.send_message(customs, definition["prompt"])
+        for member in server.members[1:4]:
+            client.react(message, options[0]["emoji"], member)
+        deadline = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        await store.add("vote", message, deadline, state, vote="squadvote",
+                        ping=None, options=[i["key"] for i in options])
+
+        await store.resume()
+        while await store.run("SELECT * FROM active"):
+            await asyncio.sleep(0.05)
+        return message
+
+    message = run(client, restart())
+
+    winner_text = definition["result"].format(
+        **customsbot.option_fields(options[0]))
+    assert message.content.startswith(winner_text)
+    assert "(3 voters)" in message.content